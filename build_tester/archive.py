@@ -0,0 +1,276 @@
+import datetime
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+import zipfile
+import zlib
+
+from build_tester.result_matrix import ResultMatrix
+
+MANIFEST_NAME = 'manifest.json'
+PACKED_DIR_NAME = 'packed'
+RUN_DIR_FORMAT = '%Y%m%d_%H%M%S'
+
+# Local file header: signature, versions, flags, method, time, date, crc, sizes, name and extra lengths
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+class Archive:
+    """
+    Archive of runs with the manifest index.
+
+    Recent runs are kept in full as dirs, older ones (see `retention_days`) are packed to one zip file per month.
+    The manifest lists all runs with their verdicts, locations and offsets of files in packs,
+    so runs and their files are found without scanning dirs and parsing packs.
+    """
+
+    def __init__(self, archive_dir_path, results_file_name='results.json', retention_days=None, log_func=print):
+        self.archive_dir_path = archive_dir_path
+        self.results_file_name = results_file_name
+        self.retention_days = retention_days
+        self.log = log_func
+
+        self.manifest_path = os.path.join(archive_dir_path, MANIFEST_NAME)
+        self.__manifest = None
+        self.__manifest_mtime = None
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def dir_name_to_datetime(dir_name):
+        try:
+            return datetime.datetime.strptime(dir_name, RUN_DIR_FORMAT)
+        except ValueError:
+            return None
+
+    #########################
+    # Manifest
+    #########################
+
+    def __scan_runs(self):
+        # Manifest is built from dirs only once, when the archive has no manifest yet
+        runs = {}
+        if not os.path.exists(self.archive_dir_path):
+            return runs
+
+        for dir_name in os.listdir(self.archive_dir_path):
+            dir_path = os.path.join(self.archive_dir_path, dir_name)
+            if not os.path.isdir(dir_path) or self.dir_name_to_datetime(dir_name) is None:
+                continue
+
+            is_ok = None
+            results_path = os.path.join(dir_path, self.results_file_name)
+            if os.path.exists(results_path):
+                with open(results_path, mode='r') as fs:
+                    try:
+                        is_ok = ResultMatrix.from_dict(json.load(fs)).is_ok()
+                    except ValueError:
+                        pass
+
+            runs[dir_name] = {'is_ok': is_ok, 'pack': None, 'files': None}
+        return runs
+
+    def __load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            if self.__manifest is None:
+                self.__manifest = {'runs': self.__scan_runs()}
+            return self.__manifest
+
+        mtime = os.path.getmtime(self.manifest_path)
+        if self.__manifest is None or mtime != self.__manifest_mtime:
+            with open(self.manifest_path, mode='r') as fs:
+                self.__manifest = json.load(fs)
+            self.__manifest_mtime = mtime
+        return self.__manifest
+
+    def __save_manifest(self):
+        os.makedirs(self.archive_dir_path, exist_ok=True)
+
+        # Manifest is replaced atomically, so readers never see a partially written file
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, mode='w') as fs:
+            json.dump(self.__manifest, fs, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+        self.__manifest_mtime = os.path.getmtime(self.manifest_path)
+
+    def refresh(self):
+        """Forgets runs found by scanning dirs, the manifest itself is reloaded after changes anyway."""
+        with self.__lock:
+            if not os.path.exists(self.manifest_path):
+                self.__manifest = None
+
+    def get_runs(self):
+        with self.__lock:
+            return sorted(self.__load_manifest()['runs'].keys())
+
+    def get_run(self, dir_name):
+        with self.__lock:
+            return self.__load_manifest()['runs'].get(dir_name)
+
+    #########################
+    # Runs
+    #########################
+
+    def add_run(self, dir_name, is_ok):
+        with self.__lock:
+            self.__load_manifest()['runs'][dir_name] = {'is_ok': is_ok, 'pack': None, 'files': None}
+            self.__save_manifest()
+
+        if self.retention_days is not None:
+            self.compact()
+
+    @staticmethod
+    def __get_data_offsets(pack_path, names):
+        offsets = {}
+        with zipfile.ZipFile(pack_path, 'r') as zip_ref, open(pack_path, mode='rb') as fs:
+            for name in names:
+                info = zip_ref.getinfo(name)
+                fs.seek(info.header_offset)
+                header = LOCAL_HEADER.unpack(fs.read(LOCAL_HEADER.size))
+                name_length, extra_length = header[-2:]
+                offsets[name] = [
+                    info.header_offset + LOCAL_HEADER.size + name_length + extra_length,
+                    info.compress_size,
+                    info.compress_type,
+                ]
+        return offsets
+
+    def __pack_run(self, dir_name):
+        dir_path = os.path.join(self.archive_dir_path, dir_name)
+        pack_name = os.path.join(PACKED_DIR_NAME, f'{dir_name[:6]}.zip')
+        pack_path = os.path.join(self.archive_dir_path, pack_name)
+        os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+
+        names = []
+        with zipfile.ZipFile(pack_path, 'a', zipfile.ZIP_DEFLATED) as zip_ref:
+            for root, _, files in os.walk(dir_path):
+                for file in files:
+                    path = os.path.join(root, file)
+                    name = f'{dir_name}/{os.path.relpath(path, dir_path)}'
+                    zip_ref.write(path, name)
+                    names.append(name)
+
+        files = {
+            name.split('/', 1)[1]: offset
+            for name, offset in self.__get_data_offsets(pack_path, names).items()
+        }
+        return pack_name, files
+
+    def compact(self, now=None):
+        """Packs runs older than `retention_days` to monthly packs and removes their dirs."""
+        now = now or time.time()
+        min_date = datetime.datetime.fromtimestamp(now) - datetime.timedelta(days=self.retention_days)
+
+        with self.__lock:
+            runs = self.__load_manifest()['runs']
+            for dir_name, run in sorted(runs.items()):
+                run_date = self.dir_name_to_datetime(dir_name)
+                if run['pack'] is not None or run_date is None or run_date >= min_date:
+                    continue
+
+                dir_path = os.path.join(self.archive_dir_path, dir_name)
+                if not os.path.exists(dir_path):
+                    continue
+
+                try:
+                    run['pack'], run['files'] = self.__pack_run(dir_name)
+                except Exception as e:
+                    self.log(f'Impossible to pack run {dir_name}:\n{e}')
+                    continue
+
+                # Manifest is saved before the dir is removed, so the run is always available
+                self.__save_manifest()
+                shutil.rmtree(dir_path)
+                self.log(f'Run {dir_name} is packed to {run["pack"]}')
+
+    #########################
+    # Files
+    #########################
+
+    def get_mtime(self, dir_name, rel_path=''):
+        """Returns mtime of the run file or dir (of the pack for packed runs) or None."""
+        run = self.get_run(dir_name)
+        if run is None:
+            return None
+
+        if run['pack'] is None:
+            path = os.path.join(self.archive_dir_path, dir_name, rel_path)
+        else:
+            path = os.path.join(self.archive_dir_path, run['pack'])
+
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def list_files(self, dir_name, sub_dir):
+        run = self.get_run(dir_name)
+        if run is None:
+            return []
+
+        if run['pack'] is None:
+            dir_path = os.path.join(self.archive_dir_path, dir_name, sub_dir)
+            return os.listdir(dir_path) if os.path.exists(dir_path) else []
+
+        prefix = f'{sub_dir}/'
+        return [path[len(prefix):] for path in run['files'] if path.startswith(prefix)]
+
+    def read_file(self, dir_name, rel_path):
+        """Returns content of the run file by the path relative to the run dir or None."""
+        run = self.get_run(dir_name)
+        if run is None:
+            return None
+
+        if run['pack'] is None:
+            path = os.path.join(self.archive_dir_path, dir_name, rel_path)
+            if not os.path.exists(path):
+                return None
+            with open(path, mode='rb') as fs:
+                return fs.read()
+
+        offset = run['files'].get(rel_path.replace(os.sep, '/'))
+        if offset is None:
+            return None
+
+        data_offset, size, compress_type = offset
+        with open(os.path.join(self.archive_dir_path, run['pack']), mode='rb') as fs:
+            fs.seek(data_offset)
+            data = fs.read(size)
+
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
+    def get_file_path(self, dir_name, rel_path):
+        """Returns path to the run file, if the run isn't packed and the file exists, otherwise None."""
+        run = self.get_run(dir_name)
+        if run is None or run['pack'] is not None:
+            return None
+
+        path = os.path.join(self.archive_dir_path, dir_name, rel_path)
+        return path if os.path.exists(path) else None
+
+    def open_file(self, dir_name, rel_path):
+        """
+        Returns binary file object of the run file by the path relative to the run dir or None,
+        so big files (e.g. logs) are read by parts. File object must be closed by the caller.
+        """
+        run = self.get_run(dir_name)
+        if run is None:
+            return None
+
+        if run['pack'] is None:
+            path = os.path.join(self.archive_dir_path, dir_name, rel_path)
+            if not os.path.exists(path):
+                return None
+            return open(path, mode='rb')
+
+        rel_path = rel_path.replace(os.sep, '/')
+        if rel_path not in run['files']:
+            return None
+
+        # Pack file stays open until the member file is closed
+        with zipfile.ZipFile(os.path.join(self.archive_dir_path, run['pack']), 'r') as zip_ref:
+            return zip_ref.open(f'{dir_name}/{rel_path}')
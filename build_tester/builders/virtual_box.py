@@ -1,10 +1,12 @@
+import json
 import os
+import time
 from collections import namedtuple
 
 from paramiko import SFTPClient
 from paramiko.common import o777
 
-from build_tester.helpers.common import wait_until, get_header_str, get_best_prepare_script
+from build_tester.helpers.common import wait_until, get_header_str, get_best_prepare_script, get_file_hash
 from build_tester.helpers.shell import ShellClient
 from build_tester.helpers.ssh import Credentials, SshClient
 
@@ -13,9 +15,22 @@ VirtualBoxInfo = namedtuple(
     field_names=(
         'os_name', 'build_name', 'vm_name', 'credentials', 'remote_dir', 'shell_path',
         'skip_prepare', 'prepare_timeout', 'run_timeout', 'skip',
+        'live_snapshot', 'max_clock_skew', 'resync_commands',
     ),
 )
 
+PREPARE_HASH_KEY = 'delivery-checker/prepare-hash'
+# Snapshots taken before the mode was saved are cold ones
+SNAPSHOT_MODE_KEY = 'delivery-checker/snapshot-mode'
+LIVE_SNAPSHOT_MODE = 'live'
+COLD_SNAPSHOT_MODE = 'cold'
+STOPPED_VM_STATES = ('poweroff', 'saved', 'aborted', 'aborted-saved')
+
+# VBoxManage has no way to wait for VM state changes,
+# so it is polled with exponential backoff
+POLL_PERIOD = 0.1
+MAX_POLL_PERIOD = 2
+
 
 class VirtualBoxBuilder:
     def __init__(
@@ -24,6 +39,7 @@ class VirtualBoxBuilder:
         prepare_dir_path='./prepare',
         install_dir_path='./install',
         tests_dir_path='./tests',
+        sync_manifests_dir_path='./sync_manifests',
         log_func=print
     ):
         self.build_info = build_info
@@ -31,7 +47,11 @@ class VirtualBoxBuilder:
         self.prepare_dir_path = prepare_dir_path
         self.install_dir_path = install_dir_path
         self.tests_dir_path = tests_dir_path
+        self.sync_manifest_path = os.path.join(sync_manifests_dir_path, f'{build_info.vm_name}.json')
         self.log = log_func
+        self.timings = {}
+        # Hashes of files uploaded to the machine since it's restored from the current snapshot
+        self.__synced_files = {}
 
         self.__shell_client = ShellClient(log_func=log_func)
         self.__ssh_client = SshClient(
@@ -63,29 +83,115 @@ class VirtualBoxBuilder:
                 prepare_timeout=vm_params[1].get('prepare_timeout'),
                 run_timeout=vm_params[1].get('run_timeout'),
                 skip=build_name in vm_params[1].get('skip', []),
+                live_snapshot=vm_params[1].get('live_snapshot', False),
+                max_clock_skew=vm_params[1].get('max_clock_skew', 60),
+                resync_commands=vm_params[1].get('resync_commands', []),
             ),
             params.items(),
         ))
 
+    def __get_vm_info(self, key):
+        output = self.__shell_client.get_command_output(
+            f'VBoxManage showvminfo {self.build_info.vm_name} --machinereadable',
+            quiet=True,
+        )
+        for line in (output or '').splitlines():
+            if line.startswith(f'{key}='):
+                return line.split('=', 1)[1].strip('"')
+
+    def __get_vm_state(self):
+        return self.__get_vm_info('VMState')
+
+    def __get_extradata(self, key):
+        output = self.__shell_client.get_command_output(
+            f'VBoxManage getextradata {self.build_info.vm_name} {key}',
+        )
+        if output is None or not output.startswith('Value:'):
+            return None
+
+        return output[len('Value:'):].strip()
+
+    def __set_extradata(self, key, value=None):
+        # Extra data key is removed when no value is passed
+        return self.__shell_client.exec_commands(
+            commands=[f'VBoxManage setextradata {self.build_info.vm_name} {key} {value or ""}'],
+        ) is None
+
+    def __load_sync_manifest(self):
+        # Manifest is kept on the host, because files in the machine are rolled back with the snapshot,
+        # and it's valid only for the snapshot it's saved with
+        try:
+            with open(self.sync_manifest_path, mode='r') as fs:
+                manifest = json.load(fs)
+        except (IOError, ValueError):
+            return {}
+
+        snapshot_uuid = self.__get_vm_info('CurrentSnapshotUUID')
+        if snapshot_uuid is None or manifest.get('snapshot') != snapshot_uuid:
+            return {}
+        return manifest.get('files', {})
+
+    def __save_sync_manifest(self):
+        # Files uploaded since the machine is restored are in the new snapshot now
+        os.makedirs(os.path.dirname(self.sync_manifest_path) or '.', exist_ok=True)
+        with open(self.sync_manifest_path, mode='w') as fs:
+            json.dump({
+                'snapshot': self.__get_vm_info('CurrentSnapshotUUID'),
+                'files': self.__synced_files,
+            }, fs)
+
+    def __remove_sync_manifest(self):
+        if os.path.exists(self.sync_manifest_path):
+            os.remove(self.sync_manifest_path)
+
+    def __wait_vm_state(self, states, timeout=60):
+        return wait_until(
+            lambda: self.__get_vm_state() in states,
+            excepted=True,
+            timeout=timeout,
+            period=POLL_PERIOD,
+            backoff=2,
+            max_period=MAX_POLL_PERIOD,
+            error_msg=f'Impossible to wait for {self.build_info.vm_name} state {"/".join(states)}',
+            log=self.log,
+        )
+
+    def __exec_with_retries(self, commands, good_errors=None, timeout=60):
+        # Machine stays locked by the session for a moment after poweroff,
+        # so commands are retried instead of sleeping for a fixed time
+        return wait_until(
+            lambda: self.__shell_client.exec_commands(commands, timeout=timeout, good_errors=good_errors),
+            timeout=timeout,
+            period=POLL_PERIOD,
+            backoff=2,
+            max_period=MAX_POLL_PERIOD,
+            error_msg=f'Impossible to execute commands for {self.build_info.vm_name}',
+            log=self.log,
+        )
+
     def restore(self, timeout=60):
         self.log(get_header_str('RESTORE STEP'))
 
         try:
             vm_name = self.build_info.vm_name
             if self.__shell_client.exec_commands(
-                commands=[
-                    f'VBoxManage controlvm {vm_name} poweroff',
-                    'sleep 3',  # Wait for full poweroff
-                    f'VBoxManage snapshot {vm_name} restorecurrent',
-                ],
-                good_errors=[
-                    'not currently running',
-                    'does not have any snapshots',
-                ],
+                commands=[f'VBoxManage controlvm {vm_name} poweroff'],
+                good_errors=['not currently running'],
                 timeout=timeout,
             ) is not None:
                 return False
 
+            if not self.__wait_vm_state(STOPPED_VM_STATES, timeout):
+                return False
+
+            if not self.__exec_with_retries(
+                commands=[f'VBoxManage snapshot {vm_name} restorecurrent'],
+                good_errors=['does not have any snapshots'],
+                timeout=timeout,
+            ):
+                return False
+
+            self.__synced_files = self.__load_sync_manifest()
             return True
 
         except Exception as e:
@@ -93,25 +199,130 @@ class VirtualBoxBuilder:
 
         return False
 
+    def __has_base_snapshot(self):
+        return self.__shell_client.exec_commands(
+            commands=[f'VBoxManage snapshot {self.build_info.vm_name} showvminfo base'],
+        ) is None
+
+    def __get_snapshot_mode(self):
+        return LIVE_SNAPSHOT_MODE if self.build_info.live_snapshot else COLD_SNAPSHOT_MODE
+
+    def __take_base_snapshot(self, timeout):
+        live_flag = ' --live' if self.build_info.live_snapshot else ''
+        if self.__shell_client.exec_commands(
+            commands=[f'VBoxManage snapshot {self.build_info.vm_name} take base{live_flag}'],
+            timeout=timeout,
+        ) is not None:
+            return False
+
+        self.__save_sync_manifest()
+        return self.__set_extradata(SNAPSHOT_MODE_KEY, self.__get_snapshot_mode())
+
+    def __is_snapshot_mode_matched(self):
+        snapshot_mode = self.__get_extradata(SNAPSHOT_MODE_KEY) or COLD_SNAPSHOT_MODE
+        if snapshot_mode == self.__get_snapshot_mode():
+            return True
+
+        self.log(f'Base snapshot is {snapshot_mode}, but {self.__get_snapshot_mode()} one is required, retake it\n')
+        return False
+
+    def __delete_base_snapshot(self, timeout):
+        vm_name = self.build_info.vm_name
+        # Commands are retried one by one, and the snapshot deleted by the previous attempt
+        # is not found on retry
+        if not self.__exec_with_retries(
+            commands=[f'VBoxManage snapshot {vm_name} delete base'],
+            good_errors=['does not have any snapshots', 'could not find a snapshot'],
+            timeout=timeout,
+        ):
+            return False
+
+        # Machine restored from the live snapshot is in the saved state, it's booted from scratch for the cold one
+        if self.__get_vm_state() in ('saved', 'aborted-saved'):
+            if not self.__exec_with_retries([f'VBoxManage discardstate {vm_name}'], timeout=timeout):
+                return False
+
+        self.__remove_sync_manifest()
+        return True
+
+    def __sync_base_files(self):
+        # Files that are the same for all builds are uploaded before the base snapshot is taken,
+        # so they are kept by the snapshot and not uploaded again after restore (see `__save_sync_manifest`)
+        self.__ssh_client.sync_files(
+            files=[(os.path.join(self.scripts_dir_path, 'init.lua'), 'init.lua', None)],
+            remote_dir=self.build_info.remote_dir,
+            manifest=self.__synced_files,
+        )
+
+    def __resync(self, timeout=60):
+        output = self.__ssh_client.get_ssh_command_output('date +%s', timeout=timeout)
+        if output is None:
+            return False
+
+        host_time = int(time.time())
+        clock_skew = abs(host_time - int(output.split()[0]))
+        if clock_skew <= self.build_info.max_clock_skew:
+            return True
+
+        # Clock skew means that the snapshot was saved long ago,
+        # so network settings (e.g. DHCP lease) may be expired too
+        self.log(f'Snapshot is stale, guest clock skew is {clock_skew} sec\n')
+        sudo = '' if self.build_info.credentials.login == 'root' else 'sudo '
+        return self.__ssh_client.exec_ssh_commands(
+            commands=[
+                f'{sudo}date -u -s @{host_time} || {sudo}date -u -f %s {host_time}',
+                *self.build_info.resync_commands,
+            ],
+            timeout=timeout,
+        ) is None
+
+    def __wait_ssh(self, timeout):
+        if not self.__ssh_client.wait_ssh(timeout, reconnect=True):
+            return False
+
+        self.timings['ssh_ready'] = round(self.__ssh_client.ready_time, 2)
+        return True
+
     def start(self, timeout=60 * 5):
         self.log(get_header_str('START STEP'))
 
         try:
             vm_name = self.build_info.vm_name
-
+            has_base_snapshot = self.__has_base_snapshot()
+            # Base snapshot is taken again when `live_snapshot` is switched in config
+            if has_base_snapshot and not self.__is_snapshot_mode_matched():
+                if not self.__delete_base_snapshot(timeout):
+                    return False
+                has_base_snapshot = False
+
+            if not self.build_info.live_snapshot:
+                if not has_base_snapshot and not self.__take_base_snapshot(timeout):
+                    return False
+
+                if self.__shell_client.exec_commands(
+                    commands=[f'VBoxManage startvm --type headless {vm_name}'],
+                    timeout=timeout,
+                ) is not None:
+                    return False
+
+                return self.__wait_ssh(timeout)
+
+            # Live snapshot keeps the state of the booted machine,
+            # so it is resumed instead of booting from scratch
             if self.__shell_client.exec_commands(
-                commands=[
-                    f'VBoxManage snapshot {vm_name} showvminfo base || VBoxManage snapshot {vm_name} take base',
-                    f'VBoxManage startvm --type headless {vm_name}',
-                ],
+                commands=[f'VBoxManage startvm --type headless {vm_name}'],
                 timeout=timeout,
             ) is not None:
                 return False
 
-            if not self.__ssh_client.wait_ssh(timeout, reconnect=True):
+            if not self.__wait_ssh(timeout):
                 return False
 
-            return True
+            if has_base_snapshot:
+                return self.__resync(timeout)
+
+            self.__sync_base_files()
+            return self.__take_base_snapshot(timeout)
 
         except Exception as e:
             self.log(f'Impossible to start virtual machine:\n{e}\n')
@@ -134,23 +345,26 @@ class VirtualBoxBuilder:
         if self.build_info.skip_prepare or best_prepare_script is None:
             return True
 
+        # Base snapshot keeps the result of the last preparation, so there is
+        # nothing to do until the prepare script is changed
+        prepare_hash = get_file_hash(best_prepare_script)
+        if self.__get_extradata(PREPARE_HASH_KEY) == prepare_hash:
+            self.log(f'Base snapshot is already prepared with {os.path.basename(best_prepare_script)}\n')
+            return True
+
         if self.build_info.prepare_timeout is not None:
             timeout = self.build_info.prepare_timeout
 
         try:
-            vm_name = self.build_info.vm_name
             remote_dir = self.build_info.remote_dir
 
-            if self.__ssh_client.exec_ssh_commands(
-                commands=[f'mkdir -p {remote_dir}'],
-                timeout=timeout,
-            ) is not None:
-                return False
-
-            sftp: SFTPClient = self.__ssh_client.get_sftp()
-            sftp.chdir(remote_dir)
-            sftp.put(best_prepare_script, 'prepare.sh')
-            sftp.chmod('prepare.sh', o777)
+            # Machine is shut down by the prepare script, and the cold base snapshot is taken after it
+            self.__sync_base_files()
+            self.__ssh_client.sync_files(
+                files=[(best_prepare_script, 'prepare.sh', o777)],
+                remote_dir=remote_dir,
+                manifest=self.__synced_files,
+            )
 
             if self.__ssh_client.exec_ssh_commands(
                 commands=[os.path.join(remote_dir, 'prepare.sh')],
@@ -159,25 +373,19 @@ class VirtualBoxBuilder:
             ) is not None:
                 return False
 
-            if not wait_until(
-                lambda: self.__shell_client.exec_commands([f'VBoxManage showvminfo {vm_name} | grep "powered off"']),
-                timeout=60,
-                error_msg=f'Impossible to shutdown {vm_name}',
-                log=self.log,
-            ):
+            if not self.__wait_vm_state(['poweroff'], timeout=60):
                 return False
 
-            if self.__shell_client.exec_commands(
-                commands=[
-                    'sleep 3',  # Wait for full poweroff
-                    f'VBoxManage snapshot {vm_name} delete base',
-                    'sleep 3',  # Wait for full snapshot delete
-                ],
-                timeout=120,
-            ) is not None:
+            if not self.__set_extradata(PREPARE_HASH_KEY):
                 return False
 
-            return self.start()
+            if not self.__delete_base_snapshot(timeout=120):
+                return False
+
+            if not self.start():
+                return False
+
+            return self.__set_extradata(PREPARE_HASH_KEY, prepare_hash)
 
         except Exception as e:
             self.log(f'Impossible to prepare virtual machine:\n{e}\n')
@@ -195,22 +403,19 @@ class VirtualBoxBuilder:
             remote_results_dir = os.path.join(remote_dir, 'results')
             results_file = f'{self.build_info.vm_name}_{self.build_info.build_name}.json'
 
-            if self.__ssh_client.exec_ssh_commands(
-                commands=[f'mkdir -p {remote_results_dir}'],
-                timeout=timeout,
-            ) is not None:
-                return False
+            install_script = f'{self.build_info.os_name}_{self.build_info.build_name}.sh'
 
-            sftp: SFTPClient = self.__ssh_client.get_sftp()
-            sftp.chdir(remote_dir)
-            sftp.put(
-                os.path.join(self.install_dir_path, f'{self.build_info.os_name}_{self.build_info.build_name}.sh'),
-                'install.sh',
+            self.__ssh_client.makedirs(remote_results_dir)
+            self.__ssh_client.sync_files(
+                files=[
+                    (os.path.join(self.install_dir_path, install_script), 'install.sh', o777),
+                    (os.path.join(self.scripts_dir_path, 'init.lua'), 'init.lua', None),
+                ],
+                remote_dir=remote_dir,
+                manifest=self.__synced_files,
             )
-            sftp.chmod('install.sh', o777)
-            sftp.put(os.path.join(self.scripts_dir_path, 'init.lua'), f'init.lua')
 
-            if self.__ssh_client.exec_ssh_commands(
+            if self.__ssh_client.exec_ssh_batch(
                 commands=[
                     os.path.join(remote_dir, 'install.sh'),
                     f'cd {remote_dir} && '
@@ -218,10 +423,12 @@ class VirtualBoxBuilder:
                     f'export TNT_VERSION="{self.build_info.build_name.split("_")[-1]}" && '
                     f'tarantool init.lua',
                 ],
+                script_path=os.path.join(remote_dir, 'run.sh'),
                 timeout=timeout,
             ) is not None:
                 return False
 
+            sftp: SFTPClient = self.__ssh_client.get_sftp()
             sftp.get(
                 os.path.join(remote_results_dir, results_file),
                 os.path.join(self.tests_dir_path, results_file),
@@ -234,18 +441,27 @@ class VirtualBoxBuilder:
 
         return False
 
+    def __run_step(self, step_name, step_func):
+        start = time.time()
+        try:
+            return step_func()
+        finally:
+            self.timings[step_name] = round(time.time() - start, 2)
+
     def deploy(self):
         try:
             is_success = True
-            if not self.restore():
+            if not self.__run_step('restore', self.restore):
                 is_success = False
-            if is_success and not self.start():
+            if is_success and not self.__run_step('start', self.start):
                 is_success = False
-            if is_success and not self.prepare():
+            if is_success and not self.__run_step('prepare', self.prepare):
                 is_success = False
-            if is_success and not self.run():
+            if is_success and not self.__run_step('run', self.run):
                 is_success = False
         finally:
             self.restore()
+            # Machine is powered off, so its connection can't be reused anymore
+            self.__ssh_client.close()
 
         return is_success
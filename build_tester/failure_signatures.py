@@ -0,0 +1,81 @@
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from build_tester.helpers.log_digest import find_failed_section
+
+SIGNATURES_FILE_NAME = 'signatures.json'
+MAX_SIGNATURE_LENGTH = 200
+WORKERS = 8
+
+# Order matters: timestamps and URLs contain numbers and paths
+NORMALIZE_RULES = [
+    (re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:?\d{2})?'), '<TIME>'),
+    (re.compile(r'\b\d{2}:\d{2}:\d{2}(\.\d+)?\b'), '<TIME>'),
+    (re.compile(r'\b\w+://\S+'), '<URL>'),
+    (re.compile(r'(?<![\w.])(/[\w.+~-]+)+/?'), '<PATH>'),
+    (re.compile(r'\b\d+(\.\d+)+([-~+][\w.~+-]*)?'), '<VER>'),
+    (re.compile(r'\b(0x)?[0-9a-f]{7,}\b', re.IGNORECASE), '<HEX>'),
+    (re.compile(r'\d+'), '<N>'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize_line(line):
+    for pattern, replacement in NORMALIZE_RULES:
+        line = pattern.sub(replacement, line)
+    return line.strip()[:MAX_SIGNATURE_LENGTH]
+
+
+def get_signature(log_path):
+    """Returns the normalized line with the cause of the failure (see `find_failed_section`) or None."""
+    if not os.path.exists(log_path):
+        return None
+
+    section = find_failed_section(log_path)
+    if section is None:
+        return None
+
+    _, line = section.get_cause()
+    if line is not None:
+        return normalize_line(line.decode(errors='replace'))
+
+
+class FailureAnalyzer:
+    """Clusters failed builds of the run by signatures of the causes of failures in their logs."""
+
+    def __init__(self, workers=WORKERS, log_func=print):
+        self.workers = workers
+        self.log = log_func
+
+    def get_clusters(self, failed_builds):
+        """
+        Takes list of failed builds as (OS name, build name, path to log) and returns clusters
+        as dicts with signature and builds, the biggest clusters go first.
+        """
+        if not failed_builds:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(failed_builds), self.workers)) as executor:
+            signatures = executor.map(lambda build: get_signature(build[2]), failed_builds)
+
+            clusters = {}
+            for (os_name, build_name, _), signature in zip(failed_builds, signatures):
+                if signature is not None:
+                    clusters.setdefault(signature, []).append([os_name, build_name])
+
+        return [
+            {'signature': signature, 'builds': builds}
+            for signature, builds in sorted(clusters.items(), key=lambda item: (-len(item[1]), item[0]))
+        ]
+
+    def save_clusters(self, run_dir_path, failed_builds):
+        try:
+            clusters = self.get_clusters(failed_builds)
+            with open(os.path.join(run_dir_path, SIGNATURES_FILE_NAME), mode='w') as fs:
+                json.dump(clusters, fs, indent=4)
+            return clusters
+
+        except Exception as e:
+            self.log(f'Impossible to cluster failed builds:\n{e}')
@@ -1,6 +1,10 @@
+import hashlib
 import os
 import time
 
+# Failed commands with accepted errors are marked in logs, so they aren't taken for causes of failures
+ACCEPTED_ERROR_TITLE = 'ACCEPTED ERROR'
+
 
 def get_best_prepare_script(prepare_dir_path, set_1, set_2=None):
     set_2 = set_2 or set()
@@ -24,7 +28,18 @@ def get_best_prepare_script(prepare_dir_path, set_1, set_2=None):
     return best_script_name
 
 
-def wait_until(func, excepted=None, timeout=30, period=1, error_msg='Impossible to wait', log=print, *args, **kwargs):
+def get_file_hash(path, chunk_size=1024 * 1024):
+    file_hash = hashlib.sha256()
+    with open(path, mode='rb') as fs:
+        for chunk in iter(lambda: fs.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def wait_until(
+    func, excepted=None, timeout=30, period=1, error_msg='Impossible to wait', log=print,
+    backoff=1, max_period=None, *args, **kwargs
+):
     end = time.time() + timeout
     while time.time() < end:
         try:
@@ -32,7 +47,10 @@ def wait_until(func, excepted=None, timeout=30, period=1, error_msg='Impossible
                 return True
         except Exception as e:
             log(f'{error_msg}: {e}\n')
-        time.sleep(period)
+        time.sleep(max(min(period, end - time.time()), 0))
+        period *= backoff
+        if max_period is not None:
+            period = min(period, max_period)
 
     log(f'{error_msg}: timeout\n')
     return False
@@ -60,6 +78,10 @@ def get_title_str(name):
     return f'[{name}]: '
 
 
+def log_accepted_error(good_error, log=print):
+    print_logs(out_data=get_lines_with_title(ACCEPTED_ERROR_TITLE, good_error, with_new_line=False), log=log)
+
+
 def get_lines_with_title(name, data, with_new_line=True):
     if len(str(data).strip()) == 0:
         return None
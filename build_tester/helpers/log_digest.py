@@ -0,0 +1,212 @@
+import gzip
+import mmap
+import os
+import re
+import shutil
+from collections import deque
+
+from build_tester.helpers.common import ACCEPTED_ERROR_TITLE
+
+DIGESTS_DIR_NAME = 'digests'
+EXCERPT_SUFFIX = '.excerpt.txt'
+GZIP_SUFFIX = '.gz'
+
+CONTEXT_LINES = 20
+MAX_LINE_LENGTH = 300
+
+ERROR_RE = re.compile(
+    rb'\b(error|errors|failed|failure|fatal|exception|traceback|timeout|not found|no such|cannot|unable|impossible)\b',
+    re.IGNORECASE,
+)
+# Sections of logs are started by headers and subheaders (see `get_header_str` and `get_subheader_str`)
+SEPARATOR_RE = re.compile(rb'^(=|-){80}$')
+# Titles of outputs, exit codes and accepted errors (see `get_title_str`)
+TITLE_RE = re.compile(rb'^\[(?:STDOUT|STDERR|LOGS)\]: ?$')
+EXIT_CODE_RE = re.compile(rb'^\[(?:STEP )?EXIT CODE\]: (-?\d+)$')
+ACCEPTED_ERROR_RE = re.compile(rb'^\[' + ACCEPTED_ERROR_TITLE.encode() + rb'\]: ')
+
+
+def get_digest_paths(log_name):
+    """Returns paths of the excerpt and the compressed copy of the log relative to the run dir."""
+    return (
+        os.path.join(DIGESTS_DIR_NAME, f'{log_name}{EXCERPT_SUFFIX}'),
+        os.path.join(DIGESTS_DIR_NAME, f'{log_name}{GZIP_SUFFIX}'),
+    )
+
+
+def iter_lines(path):
+    """Yields lines of the file without line breaks, the file is mapped to memory instead of reading it whole."""
+    if os.path.getsize(path) == 0:
+        return
+
+    with open(path, mode='rb') as fs, mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b''):
+            yield line.rstrip(b'\r\n')
+
+
+class LogSection:
+    """
+    Section of the log started by the header or the subheader (e.g. a step or a command) with numbers
+    and contents of the lines needed to find the cause of the failure. Only output before the first
+    non-zero exit code is taken, output after it belongs to error handling.
+    """
+
+    __slots__ = (
+        'title', 'start', 'end', 'exit_code', 'exit_no', 'is_accepted',
+        'error_no', 'error_line', 'last_no', 'last_line',
+    )
+
+    def __init__(self, title, start):
+        self.title = title
+        self.start = start
+        self.end = None
+        self.exit_code = None
+        self.exit_no = None
+        self.is_accepted = False
+        self.error_no = None
+        self.error_line = None
+        self.last_no = None
+        self.last_line = None
+
+    def feed(self, line_no, line):
+        match = EXIT_CODE_RE.match(line)
+        if match is not None:
+            exit_code = int(match.group(1))
+            if not self.exit_code:
+                self.exit_code = exit_code
+                self.exit_no = line_no if exit_code != 0 else None
+            return
+
+        if ACCEPTED_ERROR_RE.match(line):
+            self.is_accepted = True
+            return
+
+        if self.exit_no is not None or TITLE_RE.match(line) or not line.strip():
+            return
+        # Lines of multiline commands are prefixed by the title
+        if self.title == b'COMMAND' and line.startswith(b'COMMAND'):
+            return
+
+        self.last_no, self.last_line = line_no, line
+        if ERROR_RE.search(line):
+            self.error_no, self.error_line = line_no, line
+
+    @property
+    def is_failed(self):
+        return bool(self.exit_code) and not self.is_accepted
+
+    def get_cause(self):
+        """Returns the number and the content of the line with the cause of the failure."""
+        if self.error_no is not None:
+            return self.error_no, self.error_line
+        return self.last_no, self.last_line
+
+
+def find_failed_section(path):
+    """
+    Returns the section of the failed command or None. It's the last section with non-zero exit code,
+    except commands with accepted errors and commands retried successfully after the failure.
+    Logs without exit codes (e.g. of Docker builds) have no failed sections, so the last section
+    with the error is returned for them.
+    """
+    failed_sections = []
+    error_section = None
+    section = LogSection(title=None, start=0)
+    expected = None  # Title is expected after the opening separator, the closing one is expected after it
+
+    def finish(section, end):
+        nonlocal failed_sections, error_section
+        section.end = end
+        if section.is_failed:
+            failed_sections.append(section)
+        elif section.exit_code == 0:
+            # Commands are retried (see `wait_until`), so the failure is fixed by the successful retry
+            failed_sections = [failed for failed in failed_sections if failed.title != section.title]
+        if not section.is_accepted and section.error_no is not None:
+            error_section = section
+
+    for line_no, line in enumerate(iter_lines(path)):
+        if SEPARATOR_RE.match(line):
+            expected = 'title' if expected != 'close' else None
+            continue
+        if expected == 'title':
+            finish(section, end=line_no - 1)
+            section = LogSection(title=line, start=line_no + 2)
+            expected = 'close'
+            continue
+        expected = None
+
+        section.feed(line_no, line)
+    finish(section, end=None)
+
+    return failed_sections[-1] if failed_sections else error_section
+
+
+class LogDigest:
+    """Extracts the failed section with lines around the cause of the failure from logs and compresses them."""
+
+    def __init__(self, context_lines=CONTEXT_LINES, log_func=print):
+        self.context_lines = context_lines
+        self.log = log_func
+
+    @staticmethod
+    def __decode(line):
+        line = line.decode(errors='replace')
+        if len(line) > MAX_LINE_LENGTH:
+            line = f'{line[:MAX_LINE_LENGTH]}...'
+        return line
+
+    def get_excerpt(self, path):
+        """
+        Returns the title of the failed section with lines around the cause of the failure in it
+        (see `find_failed_section`) or the last lines of the log.
+        """
+        section = find_failed_section(path)
+        if section is None or section.get_cause()[0] is None:
+            lines = deque(iter_lines(path), maxlen=self.context_lines)
+            if not lines:
+                return None
+            return '\n'.join(['LOG (LAST LINES):', ''] + list(map(self.__decode, lines)))
+
+        # Lines after the cause are taken up to the exit code of the failed command
+        cause_no, _ = section.get_cause()
+        first_no = max(section.start, cause_no - self.context_lines)
+        last_no = cause_no + self.context_lines
+        limit_no = section.exit_no if section.exit_no is not None else section.end
+        if limit_no is not None:
+            last_no = min(last_no, limit_no)
+
+        lines = []
+        for line_no, line in enumerate(iter_lines(path)):
+            if line_no > last_no:
+                break
+            if line_no >= first_no:
+                lines.append(line)
+
+        title = self.__decode(section.title) if section.title is not None else 'LOG'
+        kind = f'EXIT CODE {section.exit_code}' if section.is_failed else 'LAST ERROR'
+        return '\n'.join([f'{title} ({kind}):', ''] + list(map(self.__decode, lines)))
+
+    def digest_log(self, run_dir_path, log_path):
+        """Saves the excerpt and the compressed copy of the log (path relative to the run dir) to the digests dir."""
+        log_file_path = os.path.join(run_dir_path, log_path)
+        excerpt_path, gzip_path = map(
+            lambda path: os.path.join(run_dir_path, path),
+            get_digest_paths(os.path.basename(log_path)),
+        )
+        os.makedirs(os.path.dirname(excerpt_path), exist_ok=True)
+
+        try:
+            excerpt = self.get_excerpt(log_file_path)
+            if excerpt is not None:
+                with open(excerpt_path, mode='w') as fs:
+                    fs.write(excerpt)
+
+            with open(log_file_path, mode='rb') as src, gzip.open(gzip_path, mode='wb') as dst:
+                shutil.copyfileobj(src, dst)
+            return True
+
+        except Exception as e:
+            self.log(f'Impossible to make digest of log {log_path}:\n{e}')
+
+        return False
@@ -1,6 +1,6 @@
 import subprocess
 
-from build_tester.helpers.common import print_logs, get_lines_with_title
+from build_tester.helpers.common import print_logs, get_lines_with_title, log_accepted_error
 
 
 class ShellClient:
@@ -28,6 +28,24 @@ class ShellClient:
 
         return None
 
+    def get_command_output(self, command, timeout=60, quiet=False):
+        if not quiet:
+            print_logs(in_data=command, log=self.log)
+        process = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=True,
+            timeout=timeout,
+        )
+
+        if process.returncode != 0:
+            if not quiet:
+                print_logs(out_data=get_lines_with_title('STDERR', process.stderr.decode()), log=self.log)
+            return None
+
+        return process.stdout.decode()
+
     def exec_commands(self, commands, timeout=60, good_errors=None):
         good_errors = good_errors or []
 
@@ -40,6 +58,7 @@ class ShellClient:
                 for good_error in good_errors:
                     if good_error.lower() in output_lower:
                         is_good = True
+                        log_accepted_error(good_error, log=self.log)
                         break
 
                 if not is_good:
@@ -1,101 +1,285 @@
+import codecs
+import io
 import logging
 import os
-from collections import namedtuple
+import re
+import select
+import shlex
+import shutil
+import socket
+import threading
+import time
+from collections import namedtuple, deque
 
 from paramiko import SSHClient, AutoAddPolicy
 
-from build_tester.helpers.common import wait_until, print_logs, get_lines_with_title
+from build_tester.helpers.common import (
+    wait_until, print_logs, get_lines_with_title, get_title_str, get_subheader_str, get_file_hash, log_accepted_error,
+)
 
 Credentials = namedtuple(
     typename='Credentials',
     field_names=('login', 'password', 'host', 'port'),
 )
 
+# Timeout of one readiness probe, it should be short to retry soon
+PROBE_TIMEOUT = 2
+
+# Size of one read from channel and number of last output lines kept in memory
+READ_SIZE = 32 * 1024
+MAX_OUTPUT_LINES = 1000
+# Longer output without line endings is split, so it isn't kept in memory as one line
+MAX_LINE_LENGTH = 64 * 1024
+# Time to wait for the end of output after exit status is received
+# (background processes started by command may keep output open)
+EOF_TIMEOUT = 1
+
+# Uploads are written to the hidden dir and moved to the target dir only when completed
+PARTIAL_DIR_NAME = '.partial'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_RETRIES = 5
+
+# Lines printed by batch script around every step
+STEP_MARKER_RE = re.compile(r'^@@DELIVERY_CHECKER_STEP (\d+) (BEGIN|END)(?: (-?\d+))?@@$')
+
+
+class OutputBuffer:
+    """Splits stream data into lines, passes them to handler and keeps only the last ones."""
+
+    def __init__(self, line_handler, max_lines=MAX_OUTPUT_LINES):
+        self.__decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.__line_handler = line_handler
+        self.__partial_line = ''
+        self.lines = deque(maxlen=max_lines)
+
+    @staticmethod
+    def __get_last_state(line):
+        # Progress bars rewrite the line after carriage returns, so only its last state is kept,
+        # the carriage return at the end may be the first half of the line ending
+        return line[line.rfind('\r', 0, len(line) - 1) + 1:]
+
+    def feed(self, data, final=False):
+        lines = (self.__partial_line + self.__decoder.decode(data, final)).split('\n')
+        self.__partial_line = self.__get_last_state(lines.pop())
+        if (final and self.__partial_line) or len(self.__partial_line) > MAX_LINE_LENGTH:
+            lines.append(self.__partial_line)
+            self.__partial_line = ''
+        for line in lines:
+            line = self.__get_last_state(line.rstrip('\r'))
+            self.lines.append(line)
+            self.__line_handler(line)
+
+    def get_text(self):
+        return '\n'.join(self.lines)
+
+
+class SshConnection:
+    def __init__(self, ssh: SSHClient):
+        self.ssh = ssh
+        self.sftp = None
+        self.last_used = time.time()
+
+    def is_alive(self, idle_timeout):
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+
+        # Server may drop idle connection silently, so check it by sending a packet
+        if time.time() - self.last_used > idle_timeout:
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+
+        return True
+
+    def close(self):
+        if self.sftp is not None:
+            self.sftp.close()
+        self.ssh.close()
+
+
+class SshPool:
+    """
+    Authenticated SSH connections shared by all clients with the same credentials.
+
+    Exec and SFTP channels are multiplexed over one transport. Connections are
+    kept until they are closed explicitly with `close` or `close_all`.
+    """
+
+    def __init__(self, idle_timeout=30):
+        self.idle_timeout = idle_timeout
+        self.__connections = {}
+        self.__lock = threading.Lock()
+
+    def __get_connection(self, credentials: Credentials, timeout=60):
+        connection = self.__connections.get(credentials)
+        if connection is not None and not connection.is_alive(self.idle_timeout):
+            connection.close()
+            connection = None
+
+        if connection is None:
+            ssh = SSHClient()
+            ssh.set_missing_host_key_policy(AutoAddPolicy())
+            ssh.connect(
+                hostname=credentials.host, port=credentials.port,
+                username=credentials.login, password=credentials.password,
+                timeout=timeout, banner_timeout=timeout, auth_timeout=timeout,
+            )
+            connection = SshConnection(ssh)
+            self.__connections[credentials] = connection
+
+        connection.last_used = time.time()
+        return connection
+
+    def get_ssh(self, credentials: Credentials, timeout=60):
+        with self.__lock:
+            return self.__get_connection(credentials, timeout).ssh
+
+    def get_sftp(self, credentials: Credentials, timeout=60):
+        with self.__lock:
+            connection = self.__get_connection(credentials, timeout)
+            if connection.sftp is None:
+                connection.sftp = connection.ssh.open_sftp()
+            return connection.sftp
+
+    def close(self, credentials: Credentials):
+        with self.__lock:
+            connection = self.__connections.pop(credentials, None)
+            if connection is not None:
+                connection.close()
+
+    def close_all(self):
+        with self.__lock:
+            for connection in self.__connections.values():
+                connection.close()
+            self.__connections.clear()
+
+
+SSH_POOL = SshPool()
+
 
 class SshClient:
     def __init__(self, credentials: Credentials, log_func=print, shell_path='/bin/sh'):
         self.log = log_func
         self.credentials = credentials
         self.shell_path = shell_path
-        self.__ssh = None
-        self.__sftp = None
-
-    def __del__(self):
-        if self.__sftp is not None:
-            self.__sftp.close()
-        if self.__ssh is not None:
-            self.__ssh.close()
+        self.ready_time = None
 
     def __connect(self, timeout=60, reconnect=False):
-        if self.__ssh is not None:
-            if not reconnect:
-                return
-
-            self.__sftp.close()
-            self.__sftp = None
-
-            self.__ssh.close()
-            self.__ssh = None
-
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.connect(
-            hostname=self.credentials.host, port=self.credentials.port,
-            username=self.credentials.login, password=self.credentials.password,
-            timeout=timeout, banner_timeout=timeout, auth_timeout=timeout,
-        )
-        self.__ssh = ssh
+        if reconnect:
+            SSH_POOL.close(self.credentials)
+
+        return SSH_POOL.get_ssh(self.credentials, timeout)
+
+    def close(self):
+        SSH_POOL.close(self.credentials)
+
+    def __is_ssh_banner_ready(self):
+        # Port forwarding accepts connections before SSH server is started,
+        # so the port is ready only when the server sends its banner
+        with socket.create_connection(
+            (self.credentials.host, self.credentials.port),
+            timeout=PROBE_TIMEOUT,
+        ) as sock:
+            sock.settimeout(PROBE_TIMEOUT)
+            return sock.recv(4) == b'SSH-'
 
     def wait_ssh(self, timeout=60 * 10, reconnect=False):
+        start = time.time()
+        self.ready_time = None
+
+        if not wait_until(
+            self.__is_ssh_banner_ready,
+            excepted=True,
+            timeout=timeout,
+            period=0.1,
+            backoff=1.5,
+            max_period=PROBE_TIMEOUT,
+            error_msg='Impossible to get SSH banner from virtual machine',
+            log=lambda _: None,
+        ):
+            self.log('Impossible to connect to virtual machine: timeout\n')
+            return False
+
         old_level = logging.getLogger().level
         logging.getLogger().setLevel(logging.CRITICAL)
 
         connected = wait_until(
-            lambda: self.__connect(timeout=timeout, reconnect=reconnect),
-            timeout=timeout,
-            period=5,
+            lambda: self.__connect(timeout=timeout, reconnect=reconnect) is not None,
+            excepted=True,
+            timeout=max(timeout - (time.time() - start), PROBE_TIMEOUT),
+            period=0.5,
+            backoff=2,
+            max_period=5,
             error_msg='Impossible to connect to virtual machine',
             log=self.log,
         )
 
         logging.getLogger().setLevel(old_level)
 
+        if connected:
+            self.ready_time = time.time() - start
+            self.log(f'SSH is ready in {self.ready_time:.2f} sec\n')
+
         return connected
 
-    def __wait_exit_code(self, channel, timeout=60):
-        if wait_until(
-            channel.exit_status_ready,
-            excepted=True,
-            timeout=timeout,
-            error_msg='Impossible to check availability to get exit status',
-            log=self.log,
-        ):
-            return channel.recv_exit_status()
-        return 1
+    def __log_line(self, line, prefix=''):
+        if line:
+            self.log(f'{time.strftime("%H:%M:%S")} {prefix}{line}')
 
-    def __get_channel_output(self, channel):
-        channel.settimeout(1)
+    def __read_channel(self, channel, timeout=60, line_handler=None):
+        line_handler = line_handler or self.__log_line
+        stdout = OutputBuffer(line_handler)
+        stderr = OutputBuffer(lambda line: line_handler(line, 'STDERR: '))
 
-        stdout = ''
-        try:
-            stdout = channel.recv(1024 ** 3).decode()
-        except Exception as e:
-            self.log(f'Impossible to get stderr: "{e}"')
+        end = time.time() + timeout
+        eof_end = None
+        is_timeout = False
+        while True:
+            if channel.recv_ready():
+                stdout.feed(channel.recv(READ_SIZE))
+                continue
+            if channel.recv_stderr_ready():
+                stderr.feed(channel.recv_stderr(READ_SIZE))
+                continue
 
-        stderr = ''
-        try:
-            stderr = channel.recv_stderr(1024 ** 3).decode()
-        except Exception as e:
-            self.log(f'Impossible to get stderr: "{e}"')
+            now = time.time()
+            if channel.closed or (channel.eof_received and channel.exit_status_ready()):
+                break
+            if channel.exit_status_ready():
+                eof_end = eof_end or now + EOF_TIMEOUT
+                if now >= eof_end:
+                    break
+            if now >= end:
+                is_timeout = True
+                break
 
-        return f'{stdout}\n{stderr}'
+            # Channel file descriptor is ready on new data or close,
+            # exit status doesn't wake it up, so the wait is short
+            select.select([channel], [], [], min(0.1, end - now))
 
-    def exec_ssh_command(self, command, timeout=60, input_data=None):
-        self.__connect()
+        # Output may be received after the last check of readiness
+        while channel.recv_ready():
+            stdout.feed(channel.recv(READ_SIZE))
+        while channel.recv_stderr_ready():
+            stderr.feed(channel.recv_stderr(READ_SIZE))
+
+        stdout.feed(b'', final=True)
+        stderr.feed(b'', final=True)
+        output = f'{stdout.get_text()}\n{stderr.get_text()}'
+
+        if is_timeout:
+            self.log('Impossible to check availability to get exit status: timeout\n')
+            return 1, f'{output}\nCommand execution timeout'
+
+        return channel.recv_exit_status(), output
+
+    def __exec(self, command, timeout=60, input_data=None, line_handler=None):
+        ssh = self.__connect()
 
-        with self.__ssh.get_transport().open_session() as channel:
+        with ssh.get_transport().open_session() as channel:
             channel.get_pty()
-            channel.settimeout(timeout)
 
             print_logs(in_data=command, log=self.log)
             command = command.replace('\\', '\\\\').replace('"', '\\"')
@@ -103,42 +287,239 @@ class SshClient:
             if input_data is not None:
                 channel.send(input_data)
 
-            exit_code = self.__wait_exit_code(channel, timeout)
-            output = self.__get_channel_output(channel)
-            print_logs(out_data=get_lines_with_title('LOGS', output), log=self.log)
+            self.log(get_title_str('LOGS'))
+            exit_code, output = self.__read_channel(channel, timeout, line_handler)
+            self.log('')
             print_logs(out_data=get_lines_with_title('EXIT CODE', str(exit_code), with_new_line=False), log=self.log)
-            if exit_code != 0:
-                return output
+            return exit_code, output
+
+    def exec_ssh_command(self, command, timeout=60, input_data=None):
+        exit_code, output = self.__exec(command, timeout=timeout, input_data=input_data)
+        if exit_code != 0:
+            return output
+
+    def get_ssh_command_output(self, command, timeout=60):
+        exit_code, output = self.__exec(command, timeout=timeout)
+        if exit_code == 0:
+            return output
+
+    def __is_good_error(self, output, good_errors):
+        output_lower = output.lower()
+        for good_error in good_errors:
+            if good_error.lower() in output_lower:
+                log_accepted_error(good_error, log=self.log)
+                return True
+        return False
 
     def exec_ssh_commands(self, commands, timeout=60, good_errors=None):
         good_errors = good_errors or []
 
         for command in commands:
             output = self.exec_ssh_command(command, timeout=timeout)
-            if output is not None:
-                output_lower = output.lower()
+            if output is not None and not self.__is_good_error(output, good_errors):
+                return output
+
+    def __get_batch_script(self, commands, script_path, good_errors, timeout):
+        lines = [
+            '#!/bin/sh',
+            '',
+            '# Every step is limited by timeout, when the utility is available',
+            'step_timeout=""',
+            'if command -v timeout > /dev/null 2>&1; then',
+            f'    step_timeout="timeout {timeout}"',
+            'fi',
+            '',
+            'run_step() {',
+            '    echo "@@DELIVERY_CHECKER_STEP $1 BEGIN@@"',
+            f'    {{ ${{step_timeout}} {self.shell_path} -c "$2"; echo $? > "{script_path}.rc"; }} 2>&1 '
+            f'| tee "{script_path}.out"',
+            f'    exit_code=$(cat "{script_path}.rc")',
+            '    if [ -n "${step_timeout}" ] && [ "${exit_code}" -eq 124 ]; then',
+            f'        echo "Step is interrupted by timeout of {timeout} sec"',
+            '    fi',
+            '    echo "@@DELIVERY_CHECKER_STEP $1 END ${exit_code}@@"',
+        ]
+        if good_errors:
+            patterns = ' '.join(map(lambda good_error: f'-e {shlex.quote(good_error)}', good_errors))
+            lines.append(
+                f'    if [ "${{exit_code}}" -ne 0 ] && ! grep -qiF {patterns} "{script_path}.out"; then'
+            )
+        else:
+            lines.append('    if [ "${exit_code}" -ne 0 ]; then')
+        lines += [
+            '        exit "${exit_code}"',
+            '    fi',
+            '}',
+            '',
+        ]
+        for i, command in enumerate(commands):
+            lines.append(f'run_step {i} {shlex.quote(command)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def exec_ssh_batch(self, commands, script_path, timeout=60, good_errors=None):
+        """
+        Same as `exec_ssh_commands`, but all commands are uploaded as one script
+        and executed in one session. Timeout is applied to every command by `timeout` utility
+        on the remote side, and the whole session is limited by the sum of steps timeouts.
+        """
+        good_errors = good_errors or []
+
+        script = self.__get_batch_script(commands, script_path, good_errors, timeout)
+        self.get_sftp().putfo(io.BytesIO(script.encode()), script_path)
 
-                is_good = False
-                for good_error in good_errors:
-                    if good_error.lower() in output_lower:
-                        is_good = True
-                        break
+        steps_output = []
+        steps_exit_code = []
 
-                if not is_good:
-                    return output
+        def handle_line(line, prefix=''):
+            match = STEP_MARKER_RE.match(line.strip())
+            if match is None:
+                if steps_output:
+                    steps_output[-1].append(line)
+                self.__log_line(line, prefix)
+            elif match.group(2) == 'BEGIN':
+                command = commands[int(match.group(1))]
+                self.log(get_subheader_str(f'STEP: {command}'))
+                steps_output.append(deque(maxlen=MAX_OUTPUT_LINES))
+            else:
+                step_exit_code = int(match.group(3))
+                self.log(get_lines_with_title('STEP EXIT CODE', match.group(3), with_new_line=False))
+                # Accepted error is checked right away, so it's marked in the log of its step
+                if step_exit_code != 0 and steps_output:
+                    if self.__is_good_error('\n'.join(steps_output[-1]), good_errors):
+                        step_exit_code = 0
+                steps_exit_code.append(step_exit_code)
+
+        exit_code, output = self.__exec(
+            f'{self.shell_path} {shlex.quote(script_path)}',
+            timeout=timeout * len(commands),
+            line_handler=handle_line,
+        )
+
+        for step_output, step_exit_code in zip(steps_output, steps_exit_code):
+            if step_exit_code != 0:
+                return '\n'.join(step_output)
+
+        # Script is interrupted (e.g. by timeout) before the end of the step
+        if exit_code != 0 or len(steps_exit_code) != len(commands):
+            return output
 
     def get_sftp(self):
-        self.__connect()
+        return SSH_POOL.get_sftp(self.credentials)
+
+    def makedirs(self, path):
+        sftp = self.get_sftp()
+        dir_path = '/' if path.startswith('/') else ''
+        for dir_name in filter(None, path.split('/')):
+            dir_path = os.path.join(dir_path, dir_name)
+            try:
+                sftp.stat(dir_path)
+            except IOError:
+                sftp.mkdir(dir_path)
+
+    def sync_files(self, files, remote_dir, manifest):
+        """
+        Uploads files to remote dir skipping ones that are not changed since the last sync.
 
-        if self.__sftp is not None:
-            return self.__sftp
+        Files is a list of (local_path, remote_name, mode) tuples, mode can be None.
+        Manifest is a dict with hashes of uploaded files by remote paths, it's updated in place
+        and kept by the caller, because the remote side may be rolled back (e.g. to VM snapshot).
+        Size of remote file is checked to find files changed by someone else.
+        """
+        sftp = self.get_sftp()
+        self.makedirs(remote_dir)
 
-        self.__sftp = self.__ssh.open_sftp()
-        return self.__sftp
+        remote_sizes = {attr.filename: attr.st_size for attr in sftp.listdir_attr(remote_dir)}
 
-    def send_file(self, zip_name='output.zip', remote_dir='.', timeout=60 * 5):
+        for local_path, remote_name, mode in files:
+            remote_path = os.path.join(remote_dir, remote_name)
+            file_hash = get_file_hash(local_path)
+            if manifest.get(remote_path) == file_hash and remote_sizes.get(remote_name) == os.path.getsize(local_path):
+                self.log(f'File {remote_name} is not changed, skip uploading\n')
+                continue
+
+            self.log(f'Upload {local_path} to {remote_path}\n')
+            # Hash is removed first, so the manifest doesn't lie about partially uploaded file
+            manifest.pop(remote_path, None)
+            with open(local_path, mode='rb') as local_fs:
+                with sftp.open(remote_path, mode='wb') as remote_fs:
+                    # Writes are not acknowledged one by one, and permissions
+                    # are set by the same handle without another path lookup
+                    remote_fs.set_pipelined(True)
+                    shutil.copyfileobj(local_fs, remote_fs, READ_SIZE)
+                    if mode is not None:
+                        remote_fs.chmod(mode)
+
+            manifest[remote_path] = file_hash
+
+    def __upload_chunks(self, local_path, remote_path, timeout=60 * 5, chunk_size=UPLOAD_CHUNK_SIZE):
+        sftp = self.get_sftp()
+        sftp.get_channel().settimeout(timeout)
+
+        # Size of remote file is the offset confirmed by server
+        file_size = os.path.getsize(local_path)
         try:
-            self.exec_ssh_command(f'mkdir -p {remote_dir}', timeout=timeout)
-            self.get_sftp().put(zip_name, os.path.join(remote_dir, zip_name))
-        finally:
-            os.remove(zip_name)
+            offset = sftp.stat(remote_path).st_size
+        except IOError:
+            offset = 0
+        if offset > file_size:
+            offset = 0
+
+        if offset == file_size:
+            return
+        if offset > 0:
+            self.log(f'Resume upload of {local_path} from {offset} of {file_size} bytes\n')
+
+        with open(local_path, mode='rb') as local_fs:
+            with sftp.open(remote_path, mode='r+b' if offset > 0 else 'wb') as remote_fs:
+                local_fs.seek(offset)
+                remote_fs.seek(offset)
+                remote_fs.set_pipelined(True)
+                for chunk in iter(lambda: local_fs.read(chunk_size), b''):
+                    remote_fs.write(chunk)
+
+    def __get_remote_file_hash(self, remote_path, timeout=60):
+        remote_path = shlex.quote(remote_path)
+        output = self.get_ssh_command_output(
+            f'sha256sum {remote_path} 2>/dev/null || shasum -a 256 {remote_path}',
+            timeout=timeout,
+        )
+        if output is not None and output.split():
+            return output.split()[0]
+
+    def upload_file(self, local_path, remote_path, timeout=60 * 5, retries=UPLOAD_RETRIES):
+        """
+        Uploads file in chunks, resuming from the last written offset after connection errors.
+
+        File is uploaded to the partial file in a hidden dir, checked by SHA-256
+        on the remote side and then atomically renamed to remote path.
+        """
+        file_hash = get_file_hash(local_path)
+        remote_dir, remote_name = os.path.split(remote_path)
+        partial_dir = os.path.join(remote_dir, PARTIAL_DIR_NAME)
+        partial_name = f'{remote_name}.{file_hash[:16]}.part'
+        partial_path = os.path.join(partial_dir, partial_name)
+
+        for attempt in range(1, retries + 1):
+            try:
+                self.makedirs(partial_dir)
+                self.__upload_chunks(local_path, partial_path, timeout)
+                break
+            except Exception as e:
+                self.log(f'Impossible to upload {local_path} (attempt {attempt} of {retries}): {e}\n')
+                if attempt == retries:
+                    raise
+                self.close()
+                time.sleep(2 ** attempt)
+
+        sftp = self.get_sftp()
+        if self.__get_remote_file_hash(partial_path, timeout) != file_hash:
+            sftp.remove(partial_path)
+            raise Exception(f'Checksum of uploaded file {partial_path} does not match')
+
+        sftp.posix_rename(partial_path, remote_path)
+
+        # Remove files left by previous uploads interrupted for good
+        for file_name in sftp.listdir(partial_dir):
+            if file_name.startswith(f'{remote_name}.') and file_name.endswith('.part'):
+                sftp.remove(os.path.join(partial_dir, file_name))
@@ -1,30 +1,75 @@
 import os
+import time
 import zipfile
 
+CODECS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+
+# Files in these formats are already compressed, so they are stored as is
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.7z', '.rpm', '.deb', '.png', '.jpg', '.jpeg',
+}
+
 
 class Zip:
-    def __zip_one(self, fp, path, rel_dir='.'):
+    def __init__(self, codec='deflate', level=None, log_func=print):
+        assert codec in CODECS, f'Unknown compression codec {codec}, use one of: {", ".join(CODECS)}'
+
+        self.compression = CODECS[codec]
+        self.level = level
+        self.log = log_func
+
+    def __get_one(self, path, rel_dir='.'):
         rel_path = os.path.relpath(path, rel_dir)
         if rel_path != '.':
-            fp.write(path, rel_path)
-
-    def __zip_all(self, fp, path, rel_dir='.'):
-        if os.path.isdir(path):
-            for root, sub_dirs, files in os.walk(path):
-                for sub_dir in sub_dirs:
-                    self.__zip_one(fp, os.path.join(root, sub_dir), rel_dir)
-                for file in files:
-                    self.__zip_one(fp, os.path.join(root, file), rel_dir)
-        else:
-            self.__zip_one(fp, path, rel_dir)
+            return [(path, rel_path)]
+        return []
+
+    def __get_all(self, path, rel_dir='.'):
+        if not os.path.isdir(path):
+            return self.__get_one(path, rel_dir)
+
+        members = []
+        for root, sub_dirs, files in os.walk(path):
+            for sub_dir in sub_dirs:
+                members += self.__get_one(os.path.join(root, sub_dir), rel_dir)
+            for file in files:
+                members += self.__get_one(os.path.join(root, file), rel_dir)
+        return members
+
+    def __write_one(self, fp, path, rel_path):
+        compression = self.compression
+        if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+            compression = zipfile.ZIP_STORED
+
+        fp.write(path, rel_path, compress_type=compression, compresslevel=self.level)
+
+    def __zip(self, paths, rel_dir='.', zip_name='output.zip'):
+        start = time.time()
+
+        members = []
+        for path in paths:
+            members += self.__get_all(path, rel_dir)
+
+        with zipfile.ZipFile(zip_name, 'w', self.compression, compresslevel=self.level) as fp:
+            for path, rel_path in members:
+                self.__write_one(fp, path, rel_path)
+
+            files_size = sum(map(lambda info: info.file_size, fp.infolist()))
+
+        zip_size = os.path.getsize(zip_name)
+        ratio = files_size / zip_size if zip_size else 0
+        self.log(
+            f'Archive {zip_name}: {len(members)} entries, {files_size} -> {zip_size} bytes, '
+            f'compression ratio {ratio:.2f}, time {time.time() - start:.2f} sec\n'
+        )
 
     def zip_path(self, path, rel_dir='.', zip_name='output.zip'):
-        fp = zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED)
-        self.__zip_all(fp, path, rel_dir)
-        fp.close()
+        self.__zip([path], rel_dir, zip_name)
 
     def zip_paths(self, paths, rel_dir='.', zip_name='output.zip'):
-        fp = zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED)
-        for path in paths:
-            self.__zip_all(fp, path, rel_dir)
-        fp.close()
+        self.__zip(paths, rel_dir, zip_name)
@@ -0,0 +1,152 @@
+import json
+import math
+from collections import namedtuple
+
+from build_tester.failure_signatures import SIGNATURES_FILE_NAME
+from build_tester.result_matrix import Result, ResultMatrix, SUCCESS_RESULTS
+
+BuildHistory = namedtuple(
+    typename='BuildHistory',
+    field_names=(
+        'os_name', 'build_name', 'runs_count', 'pass_rate', 'flake_score',
+        'duration_p50', 'duration_p90', 'duration_max', 'first_failing_run', 'duration_regression',
+    ),
+)
+
+# These results don't say anything about the build itself
+IGNORED_RESULTS = [
+    Result.NO_TEST.value,
+    Result.SKIP.value,
+    Result.CANCELED.value,
+]
+
+
+def get_percentile(values, percent):
+    """Returns the percentile by the nearest-rank method, it's always one of values (the lower one of two medians)."""
+    if not values:
+        return None
+
+    values = sorted(values)
+    # Percent is multiplied first, so the rank isn't spoiled by float errors (e.g. 0.9 * 10)
+    index = max(0, math.ceil(percent * len(values) / 100) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class History:
+    """
+    Analytics of builds results and durations over all archived runs.
+
+    Runs of the archive missing in the results store (e.g. archived before the store was used)
+    are imported to the store once, so next reports use only one query to the store.
+    """
+
+    def __init__(self, store, archive, results_file_name='results.json', timings_file_name='timings.json',
+                 log_func=print):
+        self.store = store
+        self.archive = archive
+        self.results_file_name = results_file_name
+        self.timings_file_name = timings_file_name
+        self.log = log_func
+
+    def __read_json(self, dir_name, file_name):
+        data = self.archive.read_file(dir_name, file_name)
+        if data is None:
+            return {}
+
+        try:
+            return json.loads(data)
+        except ValueError:
+            return {}
+
+    def import_archive(self):
+        stored_runs = set(map(lambda run: run['dir_name'], self.store.get_runs()))
+
+        imported = 0
+        for dir_name in self.archive.get_runs():
+            if dir_name in stored_runs:
+                continue
+
+            results = self.__read_json(dir_name, self.results_file_name)
+            timings = self.__read_json(dir_name, self.timings_file_name)
+
+            run_date = self.archive.dir_name_to_datetime(dir_name)
+            run_id = self.store.create_run(started_at=run_date.timestamp())
+            for os_name, builds in results.items():
+                for build_name, result in builds.items():
+                    self.store.save_build(
+                        run_id, os_name, build_name, result,
+                        timings=timings.get(os_name, {}).get(build_name),
+                    )
+            is_ok = self.archive.get_run(dir_name)['is_ok']
+            if is_ok is None:
+                is_ok = ResultMatrix.from_dict(results).is_ok()
+            self.store.finish_run(run_id, dir_name, is_ok)
+            imported += 1
+
+        if imported:
+            self.log(f'{imported} runs are imported from archive to results store')
+
+    @staticmethod
+    def __get_build_history(os_name, build_name, runs, window, regression_threshold):
+        results = [(dir_name, result) for dir_name, result, _ in runs if result not in IGNORED_RESULTS]
+        durations = [seconds for _, _, seconds in runs if seconds is not None]
+
+        passed = [result in SUCCESS_RESULTS for _, result in results]
+        pass_rate = sum(passed) / len(passed) if passed else None
+
+        # Flake score is a share of changes between passed and failed results in neighbour runs
+        flips = sum(prev != cur for prev, cur in zip(passed, passed[1:]))
+        flake_score = flips / (len(passed) - 1) if len(passed) > 1 else 0.0
+
+        # First run of the current series of failures
+        first_failing_run = None
+        for (dir_name, _), is_passed in zip(reversed(results), reversed(passed)):
+            if is_passed:
+                break
+            first_failing_run = dir_name
+
+        # Median duration of last runs is compared with median duration of previous runs
+        duration_regression = None
+        if len(durations) > window:
+            previous = get_percentile(durations[:-window], 50)
+            last = get_percentile(durations[-window:], 50)
+            if previous and (last - previous) / previous > regression_threshold:
+                duration_regression = (last - previous) / previous
+
+        return BuildHistory(
+            os_name=os_name,
+            build_name=build_name,
+            runs_count=len(runs),
+            pass_rate=pass_rate,
+            flake_score=flake_score,
+            duration_p50=get_percentile(durations, 50),
+            duration_p90=get_percentile(durations, 90),
+            duration_max=max(durations) if durations else None,
+            first_failing_run=first_failing_run,
+            duration_regression=duration_regression,
+        )
+
+    def get_builds_history(self, window=5, regression_threshold=0.2):
+        self.import_archive()
+
+        runs_by_builds = {}
+        for row in self.store.get_builds_history():
+            runs_by_builds.setdefault((row['os_name'], row['build_name']), []).append(
+                (row['dir_name'], row['result'], row['seconds'])
+            )
+
+        return [
+            self.__get_build_history(os_name, build_name, runs, window, regression_threshold)
+            for (os_name, build_name), runs in sorted(runs_by_builds.items())
+        ]
+
+    def get_clusters(self, dir_name=None):
+        """Returns the run (the latest one by default) and clusters of its failed builds by signatures."""
+        if dir_name is None:
+            runs = self.archive.get_runs()
+            if not runs:
+                return None, []
+            dir_name = runs[-1]
+
+        clusters = self.__read_json(dir_name, SIGNATURES_FILE_NAME)
+        return dir_name, clusters or []
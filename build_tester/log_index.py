@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+from build_tester.helpers.log_digest import iter_lines
+
+SearchResult = namedtuple(
+    typename='SearchResult',
+    field_names=('dir_name', 'log_name', 'line_no', 'line'),
+)
+
+MIN_LINE_LENGTH = 4
+MAX_LINE_LENGTH = 500
+INSERT_BATCH_SIZE = 5000
+
+
+class LogIndex:
+    """
+    Full-text index of lines of archived logs in SQLite.
+
+    FTS5 is used when SQLite is built with it, otherwise lines are searched by LIKE.
+    Same lines of one log are indexed once, runs are indexed when they are archived.
+    """
+
+    def __init__(self, db_path, log_func=print):
+        self.log = log_func
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        # Index is shared by bot handlers running in different threads
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.__lock, self.__db:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS indexed_runs (dir_name TEXT PRIMARY KEY)')
+            try:
+                self.__db.execute(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS log_lines USING fts5 '
+                    '(line, dir_name UNINDEXED, log_name UNINDEXED, line_no UNINDEXED)'
+                )
+                self.use_fts = True
+            except sqlite3.OperationalError:
+                self.__db.execute(
+                    'CREATE TABLE IF NOT EXISTS log_lines (line TEXT, dir_name TEXT, log_name TEXT, line_no INTEGER)'
+                )
+                self.use_fts = False
+
+    def close(self):
+        self.__db.close()
+
+    def get_indexed_runs(self):
+        with self.__lock:
+            return set(map(lambda row: row[0], self.__db.execute('SELECT dir_name FROM indexed_runs')))
+
+    @staticmethod
+    def __get_rows(dir_name, log_name, lines):
+        seen = set()
+        for line_no, line in enumerate(lines, start=1):
+            line = line.strip()[:MAX_LINE_LENGTH]
+            if len(line) < MIN_LINE_LENGTH or line in seen:
+                continue
+            seen.add(line)
+            yield line.decode(errors='replace'), dir_name, log_name, line_no
+
+    def __insert(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == INSERT_BATCH_SIZE:
+                self.__db.executemany('INSERT INTO log_lines VALUES (?, ?, ?, ?)', batch)
+                batch = []
+        if batch:
+            self.__db.executemany('INSERT INTO log_lines VALUES (?, ?, ?, ?)', batch)
+
+    def index_run(self, dir_name, logs):
+        """Indexes logs of the run, `logs` is an iterable of log names with iterables of their lines in bytes."""
+        with self.__lock, self.__db:
+            if self.__db.execute('SELECT 1 FROM indexed_runs WHERE dir_name = ?', (dir_name,)).fetchone():
+                return False
+
+            for log_name, lines in logs:
+                self.__insert(self.__get_rows(dir_name, log_name, lines))
+            self.__db.execute('INSERT INTO indexed_runs (dir_name) VALUES (?)', (dir_name,))
+            return True
+
+    def index_run_dir(self, dir_name, run_dir_path, log_paths):
+        """Indexes logs of the run dir, log paths are relative to the run dir."""
+        log_paths = filter(lambda path: os.path.exists(os.path.join(run_dir_path, path)), log_paths)
+        return self.index_run(dir_name, [
+            (os.path.basename(path), iter_lines(os.path.join(run_dir_path, path)))
+            for path in log_paths
+        ])
+
+    @staticmethod
+    def __iter_file_lines(fs):
+        with fs:
+            for line in fs:
+                yield line.rstrip(b'\r\n')
+
+    def __iter_archived_logs(self, archive, dir_name, logs_dir_name):
+        # Logs are opened one by one and read by lines, files of packed runs are decompressed on the fly
+        for log_name in archive.list_files(dir_name, logs_dir_name):
+            rel_path = os.path.join(logs_dir_name, log_name)
+            path = archive.get_file_path(dir_name, rel_path)
+            if path is not None:
+                yield log_name, iter_lines(path)
+                continue
+
+            fs = archive.open_file(dir_name, rel_path)
+            if fs is not None:
+                yield log_name, self.__iter_file_lines(fs)
+
+    def index_archive(self, archive, logs_dir_name='logs'):
+        """Indexes archived runs missing in the index (e.g. archived before the index was used)."""
+        indexed_runs = self.get_indexed_runs()
+
+        count = 0
+        for dir_name in archive.get_runs():
+            if dir_name in indexed_runs:
+                continue
+
+            count += self.index_run(dir_name, self.__iter_archived_logs(archive, dir_name, logs_dir_name))
+
+        if count:
+            self.log(f'{count} runs are added to logs index')
+        return count
+
+    def search(self, text, limit=20):
+        """Returns lines with the text from the latest runs."""
+        if self.use_fts:
+            query = 'SELECT dir_name, log_name, line_no, line FROM log_lines WHERE log_lines MATCH ?'
+            # Text is searched as a phrase, so special symbols of FTS queries are allowed
+            params = ['line:"{}"'.format(text.replace('"', '""'))]
+        else:
+            query = "SELECT dir_name, log_name, line_no, line FROM log_lines WHERE line LIKE ? ESCAPE '\\'"
+            escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params = [f'%{escaped}%']
+
+        query += ' ORDER BY dir_name DESC, log_name, line_no LIMIT ?'
+        with self.__lock:
+            rows = self.__db.execute(query, params + [limit]).fetchall()
+        return [SearchResult(*row) for row in rows]
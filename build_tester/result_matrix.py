@@ -0,0 +1,117 @@
+import sys
+from enum import Enum
+
+
+class Result(str, Enum):
+    NO_TEST = 'NO TEST'
+    SKIP = 'SKIP'
+    OK = 'OK'
+    TIMEOUT = 'TIMEOUT'
+    ERROR = 'ERROR'
+    FAIL = 'FAIL'
+    CANCELED = 'CANCELED'
+
+
+RESULTS_PRIORITY = {
+    Result.NO_TEST: 1,
+    Result.SKIP: 2,
+    Result.CANCELED: 3,
+    Result.OK: 4,
+    Result.TIMEOUT: 5,
+    Result.ERROR: 6,
+    Result.FAIL: 7,
+}
+
+SUCCESS_RESULTS = [
+    Result.NO_TEST,
+    Result.SKIP,
+    Result.OK,
+]
+
+FAILED_RESULTS = [result for result in Result if result not in SUCCESS_RESULTS]
+
+
+class ResultMatrix:
+    """
+    Results of builds by OS keys (OS name with version or VM name) and build names.
+
+    OS keys are indexed by base OS names from the commands list, so lost builds are found
+    by exact lookup. Base OS names are unknown for keys of remote results and of results
+    saved before base OS names were stored, such keys are indexed by the OS name before the version
+    (`ubuntu_20.04` -> `ubuntu`).
+    """
+
+    __slots__ = ('__results', '__os_index', '__guessed_os_index', '__base_os_names')
+
+    def __init__(self):
+        self.__results = {}
+        self.__os_index = {}
+        self.__guessed_os_index = {}
+        self.__base_os_names = {}
+
+    @classmethod
+    def from_dict(cls, results, base_os_names=None):
+        base_os_names = base_os_names or {}
+
+        matrix = cls()
+        for os_key, builds in results.items():
+            for build_name, result in builds.items():
+                matrix.set(os_key, build_name, result, base_os_names.get(os_key))
+        return matrix
+
+    def to_dict(self):
+        return {
+            os_key: {build_name: result.value for build_name, result in builds.items()}
+            for os_key, builds in self.__results.items()
+        }
+
+    def __iter__(self):
+        for os_key, builds in self.__results.items():
+            for build_name, result in builds.items():
+                yield os_key, build_name, result
+
+    def get(self, os_key, build_name, default=None):
+        return self.__results.get(os_key, {}).get(build_name, default)
+
+    def set(self, os_key, build_name, result, base_os_name=None):
+        os_key = sys.intern(os_key)
+        builds = self.__results.get(os_key)
+        if builds is None:
+            builds = self.__results[os_key] = {}
+        builds[sys.intern(build_name)] = Result(result)
+
+        if base_os_name:
+            self.__base_os_names[os_key] = base_os_name
+            self.__os_index.setdefault(sys.intern(base_os_name), set()).add(os_key)
+            self.__guessed_os_index.get(os_key.split('_')[0], set()).discard(os_key)
+        elif os_key not in self.__base_os_names:
+            self.__guessed_os_index.setdefault(sys.intern(os_key.split('_')[0]), set()).add(os_key)
+
+    def get_base_os_name(self, os_key):
+        return self.__base_os_names.get(os_key)
+
+    def has_os(self, base_os_name):
+        return bool(self.__os_index.get(base_os_name) or self.__guessed_os_index.get(base_os_name))
+
+    def merge(self, other):
+        """Takes results from other matrix when they have the same or higher priority and returns their cells."""
+        taken = []
+        for os_key, build_name, result in other:
+            if RESULTS_PRIORITY[result] >= RESULTS_PRIORITY[self.get(os_key, build_name, Result.NO_TEST)]:
+                self.set(os_key, build_name, result, other.get_base_os_name(os_key))
+                taken.append((os_key, build_name))
+        return taken
+
+    def add_lost_builds(self, all_builds):
+        """Adds NO TEST results for builds of OS without any results and returns them."""
+        lost_builds = [
+            (os_name, build_name)
+            for os_name, build_name in all_builds
+            if not self.has_os(os_name)
+        ]
+        for os_name, build_name in lost_builds:
+            self.set(os_name, build_name, Result.NO_TEST, os_name)
+        return lost_builds
+
+    def is_ok(self):
+        return all(map(lambda cell: cell[2] in SUCCESS_RESULTS, self))
@@ -0,0 +1,259 @@
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dir_name TEXT UNIQUE,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    is_ok INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    os_name TEXT NOT NULL,
+    build_name TEXT NOT NULL,
+    result TEXT NOT NULL,
+    base_os_name TEXT,
+    log_path TEXT,
+    tests_path TEXT,
+    UNIQUE (run_id, os_name, build_name)
+);
+CREATE INDEX IF NOT EXISTS builds_name_idx ON builds (os_name, build_name);
+CREATE INDEX IF NOT EXISTS builds_result_idx ON builds (run_id, result);
+
+CREATE TABLE IF NOT EXISTS tests (
+    build_id INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    test_name TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (build_id, test_name)
+);
+
+CREATE TABLE IF NOT EXISTS timings (
+    build_id INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    step TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (build_id, step)
+);
+'''
+
+
+def get_value(result):
+    # Result enums are saved by values
+    return str(getattr(result, 'value', result))
+
+
+class ResultsStore:
+    """
+    SQLite storage of runs, builds results, tests results, timings and paths to logs.
+
+    Paths to logs and tests are relative to the run dir, so they stay valid
+    after the run is moved to the archive.
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        # Store is shared by bot handlers running in different threads
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        with self.__lock, self.__db:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA foreign_keys=ON')
+            self.__db.executescript(SCHEMA)
+            self.__migrate()
+
+    def close(self):
+        self.__db.close()
+
+    def __migrate(self):
+        # Columns added to tables of existing stores
+        builds_columns = set(map(lambda row: row['name'], self.__db.execute('PRAGMA table_info(builds)')))
+        if 'base_os_name' not in builds_columns:
+            self.__db.execute('ALTER TABLE builds ADD COLUMN base_os_name TEXT')
+
+    def __execute(self, query, params=()):
+        with self.__lock, self.__db:
+            return self.__db.execute(query, params).fetchall()
+
+    #########################
+    # Runs
+    #########################
+
+    def create_run(self, started_at=None):
+        with self.__lock, self.__db:
+            return self.__db.execute(
+                'INSERT INTO runs (started_at) VALUES (?)',
+                (started_at or time.time(),),
+            ).lastrowid
+
+    def finish_run(self, run_id, dir_name, is_ok):
+        self.__execute(
+            'UPDATE runs SET dir_name = ?, finished_at = ?, is_ok = ? WHERE id = ?',
+            (dir_name, time.time(), int(is_ok), run_id),
+        )
+
+    def delete_unfinished_runs(self, before_run_id):
+        """
+        Deletes runs started before the run and never archived (e.g. interrupted ones),
+        their results are imported from the results file by the next run.
+        """
+        with self.__lock, self.__db:
+            return self.__db.execute(
+                'DELETE FROM runs WHERE dir_name IS NULL AND id < ?',
+                (before_run_id,),
+            ).rowcount
+
+    def get_run_id(self, dir_name):
+        rows = self.__execute('SELECT id FROM runs WHERE dir_name = ?', (dir_name,))
+        if rows:
+            return rows[0]['id']
+
+    def get_runs(self):
+        return self.__execute('SELECT * FROM runs WHERE dir_name IS NOT NULL ORDER BY dir_name')
+
+    #########################
+    # Builds
+    #########################
+
+    def save_build(self, run_id, os_name, build_name, result, base_os_name=None, log_path=None, tests_path=None,
+                   tests=None, timings=None):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                '''
+                INSERT INTO builds (run_id, os_name, build_name, result, base_os_name, log_path, tests_path)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (run_id, os_name, build_name) DO UPDATE SET
+                    result = excluded.result,
+                    base_os_name = COALESCE(excluded.base_os_name, base_os_name),
+                    log_path = COALESCE(excluded.log_path, log_path),
+                    tests_path = COALESCE(excluded.tests_path, tests_path)
+                ''',
+                (run_id, os_name, build_name, get_value(result), base_os_name, log_path, tests_path),
+            )
+            build_id = self.__db.execute(
+                'SELECT id FROM builds WHERE run_id = ? AND os_name = ? AND build_name = ?',
+                (run_id, os_name, build_name),
+            ).fetchone()['id']
+
+            if tests is not None:
+                self.__db.execute('DELETE FROM tests WHERE build_id = ?', (build_id,))
+                self.__db.executemany(
+                    'INSERT INTO tests (build_id, test_name, result) VALUES (?, ?, ?)',
+                    [(build_id, test_name, get_value(result)) for test_name, result in tests.items()],
+                )
+
+            if timings is not None:
+                self.__db.execute('DELETE FROM timings WHERE build_id = ?', (build_id,))
+                self.__db.executemany(
+                    'INSERT INTO timings (build_id, step, seconds) VALUES (?, ?, ?)',
+                    [(build_id, step, seconds) for step, seconds in timings.items()],
+                )
+
+            return build_id
+
+    def get_results(self, run_id):
+        results = {}
+        for row in self.__execute(
+            'SELECT os_name, build_name, result FROM builds WHERE run_id = ? ORDER BY id',
+            (run_id,),
+        ):
+            results.setdefault(row['os_name'], {})[row['build_name']] = row['result']
+        return results
+
+    def get_base_os_names(self, run_id):
+        """Returns base OS names from the commands list by OS keys, they are unknown for remote builds."""
+        rows = self.__execute(
+            'SELECT DISTINCT os_name, base_os_name FROM builds WHERE run_id = ? AND base_os_name IS NOT NULL',
+            (run_id,),
+        )
+        return {row['os_name']: row['base_os_name'] for row in rows}
+
+    def get_timings(self, run_id):
+        timings = {}
+        for row in self.__execute(
+            '''
+            SELECT builds.os_name, builds.build_name, timings.step, timings.seconds
+            FROM timings JOIN builds ON builds.id = timings.build_id
+            WHERE builds.run_id = ?
+            ORDER BY builds.id
+            ''',
+            (run_id,),
+        ):
+            timings.setdefault(row['os_name'], {}).setdefault(row['build_name'], {})[row['step']] = row['seconds']
+        return timings
+
+    def get_builds_files(self, run_id, column, results=None, with_names=False):
+        """
+        Returns paths to logs or tests (`column` is log_path or tests_path) with optional filter by results.
+        Paths are returned as (OS name, build name, path) tuples, if `with_names` is set.
+        """
+        assert column in ('log_path', 'tests_path'), f'Unknown files column {column}'
+
+        query = f'SELECT os_name, build_name, {column} FROM builds WHERE run_id = ? AND {column} IS NOT NULL'
+        params = [run_id]
+        if results is not None:
+            query += f' AND result IN ({", ".join("?" * len(results))})'
+            params += list(map(get_value, results))
+        query += ' ORDER BY id'
+
+        rows = self.__execute(query, params)
+        if with_names:
+            return [(row['os_name'], row['build_name'], row[column]) for row in rows]
+        return [row[column] for row in rows]
+
+    def get_build_id(self, run_id, column, path):
+        """Returns id of the build by path to its log or tests (`column` is log_path or tests_path) or None."""
+        assert column in ('log_path', 'tests_path'), f'Unknown files column {column}'
+
+        rows = self.__execute(f'SELECT id FROM builds WHERE run_id = ? AND {column} = ?', (run_id, path))
+        if rows:
+            return rows[0]['id']
+
+    def get_build(self, build_id):
+        rows = self.__execute(
+            '''
+            SELECT builds.*, runs.dir_name
+            FROM builds JOIN runs ON runs.id = builds.run_id
+            WHERE builds.id = ?
+            ''',
+            (build_id,),
+        )
+        if rows:
+            return rows[0]
+
+    def get_tests(self, run_id, tests_path):
+        rows = self.__execute(
+            '''
+            SELECT tests.test_name, tests.result
+            FROM tests JOIN builds ON builds.id = tests.build_id
+            WHERE builds.run_id = ? AND builds.tests_path = ?
+            ORDER BY tests.rowid
+            ''',
+            (run_id, tests_path),
+        )
+        return {row['test_name']: row['result'] for row in rows}
+
+    #########################
+    # History
+    #########################
+
+    def get_builds_history(self):
+        """Returns results and total durations of builds of all archived runs ordered by runs."""
+        return self.__execute(
+            '''
+            SELECT runs.dir_name, builds.os_name, builds.build_name, builds.result, timings.seconds
+            FROM builds
+            JOIN runs ON runs.id = builds.run_id
+            LEFT JOIN timings ON timings.build_id = builds.id AND timings.step = 'total'
+            WHERE runs.dir_name IS NOT NULL
+            ORDER BY runs.dir_name
+            '''
+        )
@@ -3,12 +3,19 @@ import glob
 import json
 import os
 import shutil
+import tempfile
 import zipfile
 from collections import namedtuple
-from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 
-from build_tester.helpers.ssh import SshClient, Credentials
+from build_tester.archive import Archive
+from build_tester.failure_signatures import FailureAnalyzer
+from build_tester.helpers.log_digest import LogDigest
+from build_tester.helpers.ssh import SshClient, Credentials, SSH_POOL
 from build_tester.helpers.zip import Zip
+from build_tester.log_index import LogIndex
+from build_tester.result_matrix import FAILED_RESULTS, Result, ResultMatrix
+from build_tester.results_store import ResultsStore
 from config.config import CheckerConfig
 
 RemoteInfo = namedtuple(
@@ -17,31 +24,7 @@ RemoteInfo = namedtuple(
 )
 
 
-class Result(str, Enum):
-    NO_TEST = 'NO TEST'
-    SKIP = 'SKIP'
-    OK = 'OK'
-    TIMEOUT = 'TIMEOUT'
-    ERROR = 'ERROR'
-    FAIL = 'FAIL'
-    CANCELED = 'CANCELED'
-
-
-RESULTS_PRIORITY = {
-    Result.NO_TEST: 1,
-    Result.SKIP: 2,
-    Result.CANCELED: 3,
-    Result.OK: 4,
-    Result.TIMEOUT: 5,
-    Result.ERROR: 6,
-    Result.FAIL: 7,
-}
-
-SUCCESS_RESULTS = [
-    Result.NO_TEST,
-    Result.SKIP,
-    Result.OK,
-]
+REMOTE_ARCHIVES_WORKERS = 8
 
 
 class ResultsManager:
@@ -51,7 +34,23 @@ class ResultsManager:
 
         self.log = log_func
 
-        self.__zip = Zip()
+        self.__zip = Zip(
+            codec=config.results_compression.get('codec', 'deflate'),
+            level=config.results_compression.get('level'),
+            log_func=log_func,
+        )
+
+        self.__store = ResultsStore(config.results_db_path)
+        self.__archive = Archive(
+            archive_dir_path=config.archive_dir_path,
+            results_file_name=config.results_file_name,
+            retention_days=config.archive_retention_days,
+            log_func=log_func,
+        )
+        self.__run_id = None
+        self.__log_index = LogIndex(config.log_index_db_path, log_func=log_func)
+        self.__log_digest = LogDigest(context_lines=config.log_excerpt_lines, log_func=log_func)
+        self.__failure_analyzer = FailureAnalyzer(log_func=log_func)
 
     def __parse_config(self):
         config = self.config
@@ -79,6 +78,64 @@ class ResultsManager:
                 remote_dir=config.send_to_remote.get('remote_dir', '/opt/delivery_checker/remote')
             )
 
+    def __get_run_id(self):
+        # Results of the run started by another process are imported from results file
+        if self.__run_id is None:
+            self.__run_id = self.__store.create_run()
+            if os.path.exists(self.config.results_file_path):
+                timings = {}
+                if os.path.exists(self.config.timings_file_path):
+                    with open(self.config.timings_file_path, mode='r') as fs:
+                        timings = json.load(fs)
+
+                with open(self.config.results_file_path, mode='r') as fs:
+                    for os_name, builds in json.load(fs).items():
+                        for build_name, result in builds.items():
+                            self.save_build_result(
+                                os_name, build_name, result,
+                                timings=timings.get(os_name, {}).get(build_name),
+                            )
+
+        return self.__run_id
+
+    def start_run(self):
+        self.__run_id = self.__store.create_run()
+
+    def save_build_result(self, os_name, build_name, result, timings=None, base_os_name=None):
+        log_path = os.path.join(self.config.logs_dir_name, f'{os_name}_{build_name}.log')
+        if not os.path.exists(os.path.join(self.config.local_dir_path, log_path)):
+            log_path = None
+
+        tests_path = os.path.join(self.config.tests_dir_name, f'{os_name}_{build_name}.json')
+        tests = None
+        if os.path.exists(os.path.join(self.config.local_dir_path, tests_path)):
+            with open(os.path.join(self.config.local_dir_path, tests_path), mode='r') as fs:
+                try:
+                    tests = json.load(fs)
+                except ValueError:
+                    pass
+        if tests is None:
+            tests_path = None
+
+        self.__store.save_build(
+            self.__get_run_id(), os_name, build_name, result,
+            base_os_name=base_os_name,
+            log_path=log_path,
+            tests_path=tests_path,
+            tests=tests,
+            timings=timings,
+        )
+
+    def save_results_files(self, **json_kwargs):
+        """Exports results and timings of the current run to JSON files for compatibility."""
+        run_id = self.__get_run_id()
+
+        with open(self.config.results_file_path, mode='w') as fs:
+            fs.write(json.dumps(self.__store.get_results(run_id), **json_kwargs))
+
+        with open(self.config.timings_file_path, mode='w') as fs:
+            fs.write(json.dumps(self.__store.get_timings(run_id)))
+
     def send_results(self, timeout=3 * 60):
         if self.__send_to_remote is None:
             return True
@@ -93,9 +150,9 @@ class ResultsManager:
             )
 
             ssh = SshClient(self.__send_to_remote.credentials, log_func=self.log)
-            ssh.send_file(
-                zip_name=zip_name,
-                remote_dir=f'{self.__send_to_remote.remote_dir}',
+            ssh.upload_file(
+                local_path=zip_name,
+                remote_path=os.path.join(self.__send_to_remote.remote_dir, zip_name),
                 timeout=timeout,
             )
             return True
@@ -104,96 +161,180 @@ class ResultsManager:
             self.log(f'Impossible to send results to remote server:\n{e}')
 
         finally:
-            os.remove(zip_name)
+            if os.path.exists(zip_name):
+                os.remove(zip_name)
 
         return False
 
-    def __merge_results(self, remote_path):
-        with open(self.config.results_file_path, mode='r') as fs:
-            local_results = json.load(fs)
-
-        with open(remote_path, mode='r') as fs:
-            remote_results = json.load(fs)
-
-        for os_name, builds in remote_results.items():
-            local_results[os_name] = local_results.get(os_name, {})
-            for build_name, remote_result in builds.items():
-                local_result = local_results[os_name].get(build_name, Result.NO_TEST)
-                if RESULTS_PRIORITY[remote_result] >= RESULTS_PRIORITY[local_result]:
-                    local_results[os_name][build_name] = remote_result
-
-        with open(self.config.results_file_path, mode='w') as fs:
-            fs.write(json.dumps(local_results))
-
-    def use_remote_results(self, temp_dir='./temp'):
-
-
-        for archive in glob.glob(os.path.join(self.config.remote_dir_path, '*.zip')):
+    def __read_remote_archive(self, archive):
+        """
+        Returns results and timings of the remote archive with its logs and tests extracted to temp files
+        as a dict of temp paths by target paths. Archives are read in parallel, so target files are replaced
+        later by files of the archive which result is taken.
+        """
+        target_dirs = {
+            self.config.logs_dir_name: os.path.join(self.config.local_dir_path, self.config.logs_dir_name),
+            self.config.tests_dir_name: os.path.join(self.config.local_dir_path, self.config.tests_dir_name),
+        }
+
+        remote_results = {}
+        remote_timings = {}
+        extracted_files = {}
+        try:
             with zipfile.ZipFile(archive, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-
-            for root, _, files in os.walk(os.path.join(temp_dir, self.config.logs_dir_name)):
-                for file in files:
-                    shutil.move(
-                        os.path.join(root, file),
-                        os.path.join(self.config.local_dir_path, self.config.logs_dir_name),
-                    )
+                for member in zip_ref.infolist():
+                    if member.is_dir():
+                        continue
+
+                    if member.filename == self.config.results_file_name:
+                        with zip_ref.open(member) as fs:
+                            remote_results = json.load(fs)
+                        continue
+
+                    if member.filename == self.config.timings_file_name:
+                        with zip_ref.open(member) as fs:
+                            remote_timings = json.load(fs)
+                        continue
+
+                    # Logs and tests are streamed right to the local dirs without reading them to memory
+                    target_dir = target_dirs.get(member.filename.split('/', 1)[0])
+                    if target_dir is None:
+                        continue
+
+                    target_path = os.path.join(target_dir, os.path.basename(member.filename))
+                    fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix=f'.{os.path.basename(target_path)}.')
+                    extracted_files[target_path] = tmp_path
+                    with zip_ref.open(member) as src, os.fdopen(fd, mode='wb') as dst:
+                        shutil.copyfileobj(src, dst)
+
+        except Exception:
+            self.__remove_files(extracted_files.values())
+            raise
+
+        return remote_results, remote_timings, extracted_files
+
+    @staticmethod
+    def __remove_files(paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def __get_build_file_names(os_name, build_name):
+        return [f'{os_name}_{build_name}.log', f'{os_name}_{build_name}.json']
+
+    def use_remote_results(self):
+        archives = glob.glob(os.path.join(self.config.remote_dir_path, '*.zip'))
+        if not archives:
+            return
+
+        matrix = self.get_results_matrix()
+
+        # Pool waits for all archives to be read, so temp files of every read archive are known
+        # and removed when any archive fails
+        with ThreadPoolExecutor(max_workers=min(len(archives), REMOTE_ARCHIVES_WORKERS)) as executor:
+            futures = [executor.submit(self.__read_remote_archive, archive) for archive in archives]
+        read_archives = [future.result() for future in futures if future.exception() is None]
 
-            for root, _, files in os.walk(os.path.join(temp_dir, self.config.tests_dir_name)):
-                for file in files:
-                    shutil.move(
-                        os.path.join(root, file),
-                        os.path.join(self.config.local_dir_path, self.config.tests_dir_name),
+        try:
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                raise errors[0]
+
+            # Results are merged in order of archives, so the winner of builds with same priorities is defined
+            for remote_results, remote_timings, extracted_files in read_archives:
+                remote_matrix = ResultMatrix.from_dict(remote_results)
+                taken_builds = set(matrix.merge(remote_matrix))
+
+                # Files of builds which results are not taken are dropped, other files are replaced atomically
+                dropped_names = set()
+                for os_name, build_name, _ in remote_matrix:
+                    if (os_name, build_name) not in taken_builds:
+                        dropped_names.update(self.__get_build_file_names(os_name, build_name))
+                for target_path, tmp_path in extracted_files.items():
+                    if os.path.basename(target_path) in dropped_names:
+                        os.remove(tmp_path)
+                    else:
+                        os.replace(tmp_path, target_path)
+
+                for os_name, build_name in taken_builds:
+                    self.save_build_result(
+                        os_name, build_name, matrix.get(os_name, build_name),
+                        timings=remote_timings.get(os_name, {}).get(build_name),
                     )
 
-            self.__merge_results(os.path.join(temp_dir, self.config.results_file_name))
+        except Exception:
+            # Temp files which are already moved to target paths don't exist anymore
+            for _, _, extracted_files in read_archives:
+                self.__remove_files(extracted_files.values())
+            raise
 
-            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.save_results_files()
 
     def find_lost_results(self, all_builds):
-        with open(self.config.results_file_path, mode='r') as fs:
-            results = json.load(fs)
-
-        new_results = {}
-        for build in all_builds:
-            os_name = build[0]
-            build_name = build[1]
-            if not any(map(
-                lambda os_name_version: os_name in os_name_version,
-                results.keys(),
-            )):
-                new_results[os_name] = new_results.get(os_name, {})
-                new_results[os_name][build_name] = Result.NO_TEST.value
-
-        for os_name, builds in new_results.items():
-            results[os_name] = builds
+        matrix = self.get_results_matrix()
 
-        with open(self.config.results_file_path, mode='w') as fs:
-            fs.write(json.dumps(results, sort_keys=True, indent=4))
+        for os_name, build_name in matrix.add_lost_builds(all_builds):
+            self.save_build_result(os_name, build_name, Result.NO_TEST)
+
+        self.save_results_files(sort_keys=True, indent=4)
 
     def sync_results(self, all_builds):
-        self.send_results()
+        try:
+            self.send_results()
+        finally:
+            if self.__send_to_remote is not None:
+                SSH_POOL.close(self.__send_to_remote.credentials)
+
         if not self.config.host_mode and self.config.use_remote_results:
             self.use_remote_results()
         self.find_lost_results(all_builds)
 
     def get_results(self):
-        with open(self.config.results_file_path, mode='r') as fs:
-            return json.load(fs)
+        return self.__store.get_results(self.__get_run_id())
+
+    def get_results_matrix(self):
+        run_id = self.__get_run_id()
+        return ResultMatrix.from_dict(self.__store.get_results(run_id), self.__store.get_base_os_names(run_id))
+
+    def digest_failed_logs(self):
+        for log_path in self.__store.get_builds_files(self.__get_run_id(), 'log_path', results=FAILED_RESULTS):
+            self.__log_digest.digest_log(self.config.local_dir_path, log_path)
+
+    def cluster_failures(self):
+        failed_builds = [
+            (os_name, build_name, os.path.join(self.config.local_dir_path, log_path))
+            for os_name, build_name, log_path in self.__store.get_builds_files(
+                self.__get_run_id(), 'log_path', results=FAILED_RESULTS, with_names=True,
+            )
+        ]
+        return self.__failure_analyzer.save_clusters(self.config.local_dir_path, failed_builds)
+
+    def __index_logs(self, dir_name):
+        try:
+            self.__log_index.index_run_dir(
+                dir_name,
+                run_dir_path=os.path.join(self.config.archive_dir_path, dir_name),
+                log_paths=self.__store.get_builds_files(self.__get_run_id(), 'log_path'),
+            )
+        except Exception as e:
+            self.log(f'Impossible to index logs of run {dir_name}:\n{e}')
 
     def archive_results(self):
+        is_results_ok = self.is_results_ok()
+        self.digest_failed_logs()
+        self.cluster_failures()
+
         os.makedirs(self.config.archive_dir_path, exist_ok=True)
         dir_name = f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}'
         shutil.move(self.config.local_dir_path, os.path.join(self.config.archive_dir_path, dir_name))
+
+        self.__store.finish_run(self.__get_run_id(), dir_name, is_results_ok)
+        # Results of interrupted runs are in the archived one now
+        self.__store.delete_unfinished_runs(self.__get_run_id())
+        self.__index_logs(dir_name)
+        self.__archive.add_run(dir_name, is_results_ok)
         return dir_name
 
     def is_results_ok(self):
-        with open(self.config.results_file_path, mode='r') as fs:
-            results = json.load(fs)
-        return all(map(
-            lambda builds: all(map(
-                lambda build_res: build_res in SUCCESS_RESULTS,
-                builds.values(),
-            )),
-            results.values(),
-        ))
+        return self.get_results_matrix().is_ok()
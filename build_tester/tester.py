@@ -9,7 +9,8 @@ import logging
 from build_tester.builders.docker_builder import DockerBuilder, DockerInfo
 from build_tester.builders.host_builder import HostBuilder, HostInfo
 from build_tester.builders.virtual_box import VirtualBoxBuilder, VirtualBoxInfo
-from build_tester.results_sync import ResultsManager, Result
+from build_tester.result_matrix import Result
+from build_tester.results_sync import ResultsManager
 from config.config import CheckerConfig
 
 FORMAT='%(message)s'
@@ -166,7 +167,7 @@ class Tester:
         os.makedirs(self.config.logs_dir_path)
 
         canceled = False
-        self.__results = {}
+        self.__results_manager.start_run()
         self.__builds = self.__builds or self.__download_scripts()
         if not self.__builds:
             raise ValueError('Nothing to test. Check --build and --version options are correct')
@@ -176,7 +177,7 @@ class Tester:
             log_prefix = f'OS: {os_name}. Build: {build.build_name}'
             print(f'\r{log_prefix}. Running...')
 
-            self.__results[os_name] = self.__results.get(os_name, {})
+            timings = {}
             install_logs_path = os.path.join(self.config.logs_dir_path, f'{os_name}_{build.build_name}.log')
             start = time.time()
 
@@ -203,9 +204,11 @@ class Tester:
                             prepare_dir_path=self.config.prepare_dir_path,
                             install_dir_path=self.config.install_dir_path,
                             tests_dir_path=self.config.tests_dir_path,
+                            sync_manifests_dir_path=self.config.sync_manifests_dir_path,
                             log_func=self.__log,
                         )
                         deploy_result = virtual_box_builder.deploy()
+                        timings = virtual_box_builder.timings
                     elif isinstance(build, HostInfo):
                         host_builder = HostBuilder(
                             build_info=build,
@@ -256,12 +259,16 @@ class Tester:
                 result = Result.ERROR
                 self.__save_logs(install_logs_path)
 
-            print(f'\r{log_prefix}. Elapsed time: {time.time() - start:.2f} sec. {result.value}')
+            elapsed_time = time.time() - start
+            print(f'\r{log_prefix}. Elapsed time: {elapsed_time:.2f} sec. {result.value}')
 
-            self.__results[os_name][build.build_name] = result
+            self.__results_manager.save_build_result(
+                os_name, build.build_name, result,
+                timings={**timings, 'total': round(elapsed_time, 2)},
+                base_os_name=build.os_name,
+            )
 
-        with open(self.config.results_file_path, mode='w') as fs:
-            fs.write(json.dumps(self.__results))
+        self.__results_manager.save_results_files()
 
     def find_lost_results(self):
         self.__builds = self.__builds or self.__download_scripts()
@@ -5,7 +5,7 @@ import json
 
 from build_tester.tester import Tester
 from config.config import CheckerConfig
-from telegram_bot.bot import Bot
+from telegram_bot.db import DB
 
 
 def main():
@@ -89,9 +89,11 @@ def main():
     results = tester.get_results()
     dir_name = tester.archive_results()
 
+    # Notification is sent out by the bot process
     if config.send_to_bot:
-        bot = Bot(args.config, args.debug_mode)
-        bot.send_out_builds_info(results, dir_name)
+        db = DB(config_json.get('telegram_db', {}))
+        with db.connection():
+            db.enqueue_notification(dir_name, results)
 
     return is_results_ok
 
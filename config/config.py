@@ -74,16 +74,24 @@ class CheckerConfig:
     local_dir_path: str  # Path to the archive dir in VM or container (config file or './local')
     remote_dir_path: str  # Path to the remote server dir if `use_remote_results` is True (config file or './remote')
     archive_dir_path: str  # Path to save check logs and test result (config file or './archive')
+    results_db_path: str  # Path to SQLite store of all runs results (config file or './archive/results.db')
+    log_index_db_path: str  # Path to SQLite full-text index of archived logs (config file or './archive/logs_index.db')
+    archive_retention_days: int  # Days to keep runs in full before packing them by months (config file or None)
+    sync_manifests_dir_path: str  # Path to hashes of files uploaded to VMs snapshots (config file or './sync_manifests')
     logs_dir_name: str  # Name for the check log dir (config file or 'logs')
     logs_dir_path: str  # Path to the check log dir in VM or container (config file or './local/logs')
     tests_dir_name: str  # Name for the tests results dir in VM or container (config file or 'tests')
     tests_dir_path: str  # Path to tests results dir in VM or container (config file or './local/tests')
     results_file_name: str  # Name of the file with check results (config file or 'result.json')
     results_file_path: str  # Path to the result file (config file or './local/results.json')
+    timings_file_name: str  # Name of the file with builds steps timings (config file or 'timings.json')
+    timings_file_path: str  # Path to the timings file (config file or './local/timings.json')
+    log_excerpt_lines: int  # Lines around the cause of the failure in excerpts of failed logs (config file or 20)
     default_use_cache: bool  # Whether to use Docker cache or not (config file or 'False')
 
     # Parameters for the remote configuration
     send_to_remote: dict  # Params for connection to remote server for the check (config file)
+    results_compression: dict  # Codec and level to compress results sent to remote server (config file)
     send_to_bot: bool  # Send results to bot (config file)
     use_remote_results: bool  # True, if we use remote server (config file or 'False')
 
@@ -146,6 +154,16 @@ class CheckerConfig:
         self.local_dir_path = config_json.get('local_dir_path', './local')
         self.remote_dir_path = config_json.get('remote_dir_path', './remote')
         self.archive_dir_path = config_json.get('archive_dir_path', './archive')
+        self.results_db_path = config_json.get(
+            'results_db_path',
+            os.path.join(self.archive_dir_path, 'results.db'),
+        )
+        self.log_index_db_path = config_json.get(
+            'log_index_db_path',
+            os.path.join(self.archive_dir_path, 'logs_index.db'),
+        )
+        self.archive_retention_days = config_json.get('archive_retention_days')
+        self.sync_manifests_dir_path = config_json.get('sync_manifests_dir_path', './sync_manifests')
 
         self.logs_dir_name = config_json.get('logs_dir_name', 'logs')
         self.logs_dir_path = os.path.join(self.local_dir_path, self.logs_dir_name)
@@ -156,9 +174,14 @@ class CheckerConfig:
         self.results_file_name = config_json.get('results_file_name', 'results.json')
         self.results_file_path = os.path.join(self.local_dir_path, self.results_file_name)
 
+        self.timings_file_name = config_json.get('timings_file_name', 'timings.json')
+        self.timings_file_path = os.path.join(self.local_dir_path, self.timings_file_name)
+        self.log_excerpt_lines = config_json.get('log_excerpt_lines', 20)
+
         self.default_use_cache = config_json.get('default_use_cache', False)
 
         self.send_to_remote = config_json.get('send_to_remote', {})
+        self.results_compression = config_json.get('results_compression', {})
         self.send_to_bot = config_json.get('send_to_bot', False)
         self.use_remote_results = config_json.get('use_remote_results', False)
 
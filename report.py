@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+
+from build_tester.archive import Archive
+from build_tester.history import History
+from build_tester.results_store import ResultsStore
+
+
+def format_value(value, fmt='{:.2f}'):
+    if value is None:
+        return '-'
+    return fmt.format(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tarantool Delivery Checker history report')
+    parser.add_argument(
+        '-c', '--config', default='./config.json',
+        help='Path to config',
+    )
+    parser.add_argument(
+        '-w', '--window', type=int, default=5,
+        help='Number of last runs to compare durations with previous runs',
+    )
+    parser.add_argument(
+        '-t', '--regression-threshold', type=float, default=0.2,
+        help='Share of duration growth to mark the build as regressed, e.g. 0.2 for 20%%',
+    )
+    parser.add_argument(
+        '-r', '--run',
+        help='Archived run (dir name) to show failure causes, the latest one by default',
+    )
+    parser.add_argument(
+        '-f', '--only-problems', action='store_true',
+        help='Use this flag to show only failing, flaky and regressed builds',
+    )
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fs:
+        config = json.load(fs)
+
+    archive_dir_path = config.get('archive_dir_path', './archive')
+    results_file_name = config.get('results_file_name', 'results.json')
+    history = History(
+        store=ResultsStore(config.get('results_db_path', os.path.join(archive_dir_path, 'results.db'))),
+        archive=Archive(archive_dir_path, results_file_name=results_file_name),
+        results_file_name=results_file_name,
+        timings_file_name=config.get('timings_file_name', 'timings.json'),
+    )
+
+    builds = history.get_builds_history(window=args.window, regression_threshold=args.regression_threshold)
+    if args.only_problems:
+        builds = list(filter(
+            lambda build: build.first_failing_run or build.flake_score or build.duration_regression,
+            builds,
+        ))
+
+    print(
+        f'{"OS":<24} {"Build":<24} {"Runs":>5} {"Pass":>6} {"Flake":>6} '
+        f'{"p50, s":>8} {"p90, s":>8} {"Max, s":>8} {"Regress":>8}  First failing run'
+    )
+    for build in builds:
+        print(
+            f'{build.os_name:<24} {build.build_name:<24} {build.runs_count:>5} '
+            f'{format_value(build.pass_rate, "{:.0%}"):>6} {format_value(build.flake_score):>6} '
+            f'{format_value(build.duration_p50):>8} {format_value(build.duration_p90):>8} '
+            f'{format_value(build.duration_max):>8} {format_value(build.duration_regression, "{:+.0%}"):>8}  '
+            f'{build.first_failing_run or "-"}'
+        )
+
+    dir_name, clusters = history.get_clusters(args.run)
+    if clusters:
+        print(f'\nFailure causes in run {dir_name}:')
+        for cluster in clusters:
+            builds = ', '.join(map(lambda build: f'{build[0]} {build[1]}', cluster['builds']))
+            print(f'{len(cluster["builds"]):>5}  {cluster["signature"]}\n       {builds}')
+
+    return True
+
+
+if __name__ == '__main__':
+    exit(not main())
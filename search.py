@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import time
+
+from build_tester.archive import Archive
+from build_tester.log_index import LogIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tarantool Delivery Checker logs search')
+    parser.add_argument(
+        'text',
+        help='Text to search in logs of archived runs',
+    )
+    parser.add_argument(
+        '-c', '--config', default='./config.json',
+        help='Path to config',
+    )
+    parser.add_argument(
+        '-n', '--limit', type=int, default=20,
+        help='Maximum number of found lines',
+    )
+    parser.add_argument(
+        '-i', '--index-archive', action='store_true',
+        help='Use this flag to index archived runs missing in the index before the search',
+    )
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fs:
+        config = json.load(fs)
+
+    archive_dir_path = config.get('archive_dir_path', './archive')
+    log_index = LogIndex(config.get('log_index_db_path', os.path.join(archive_dir_path, 'logs_index.db')))
+    if args.index_archive:
+        archive = Archive(archive_dir_path, results_file_name=config.get('results_file_name', 'results.json'))
+        log_index.index_archive(archive, config.get('logs_dir_name', 'logs'))
+
+    start = time.time()
+    results = log_index.search(args.text, limit=args.limit)
+    for result in results:
+        print(f'{result.dir_name} {result.log_name}:{result.line_no}: {result.line}')
+    print(f'Found {len(results)} lines in {(time.time() - start) * 1000:.0f} ms')
+
+    return len(results) > 0
+
+
+if __name__ == '__main__':
+    exit(not main())
@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger('ArchiveIndex')
+
+DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
+
+
+class ArchiveIndex:
+    """
+    Sorted in-memory list of archived runs with their labels for the bot.
+
+    The index is loaded once and reloaded by the watcher thread only when the archive dir
+    or its manifest are changed, so pages of runs are just slices of the list.
+    """
+
+    def __init__(self, archive, poll_period=5):
+        self.archive = archive
+        self.poll_period = poll_period
+
+        self.__lock = threading.Lock()
+        self.__runs = []
+        self.__labels = {}
+        self.__state = None
+
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+        self.refresh()
+
+    def __get_state(self):
+        state = []
+        for path in (self.archive.archive_dir_path, self.archive.manifest_path):
+            try:
+                state.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def refresh(self):
+        state = self.__get_state()
+        if state == self.__state:
+            return False
+
+        self.archive.refresh()
+        runs = []
+        labels = {}
+        # Newest runs go first
+        for dir_name in reversed(self.archive.get_runs()):
+            run_date = self.archive.dir_name_to_datetime(dir_name)
+            if run_date is None:
+                continue
+            runs.append(dir_name)
+            labels[dir_name] = run_date.strftime(DATE_FORMAT)
+
+        with self.__lock:
+            self.__runs = runs
+            self.__labels = labels
+            self.__state = state
+
+        logger.info(f'Archive index is reloaded, {len(runs)} runs')
+        return True
+
+    def __watch(self):
+        # Changes are polled by file stats, it works the same way for local dirs and network mounts
+        while not self.__stop_event.wait(self.poll_period):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f'Impossible to reload archive index:\n{e}')
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__watch, name='ArchiveIndexWatcher', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def get_label(self, dir_name):
+        return self.__labels.get(dir_name)
+
+    def get_page(self, count=10, page=1):
+        """Returns runs of the page (from the end for negative pages, all for 0) and whether it's the last one."""
+        with self.__lock:
+            runs = self.__runs
+
+        if page == 0:
+            return list(runs), True
+
+        if page > 0:
+            begin = count * (page - 1)
+            end = count * page
+        else:
+            begin = max(0, len(runs) + count * page)
+            end = len(runs) + count * (page + 1)
+
+        return runs[begin:end], end >= len(runs)
@@ -2,20 +2,38 @@ import datetime
 import json
 import logging
 import os
+import re
 import textwrap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import emoji as emoji
-from telebot import types, TeleBot
+from telebot import types, TeleBot, apihelper
 from telebot.apihelper import ApiTelegramException
 
-from build_tester.results_sync import SUCCESS_RESULTS
+from build_tester.archive import Archive
+from build_tester.failure_signatures import SIGNATURES_FILE_NAME
+from build_tester.helpers.log_digest import get_digest_paths
+from build_tester.log_index import LogIndex
+from build_tester.result_matrix import FAILED_RESULTS, SUCCESS_RESULTS
+from build_tester.results_store import ResultsStore
+from telegram_bot.archive_index import ArchiveIndex
+from telegram_bot.cache import MtimeCache
 from telegram_bot.db import DB, SubscribeType
+from telegram_bot.rate_limit import RateLimiter
+from telegram_bot.webhook import WebhookServer
 
 logger = logging.getLogger('Bot')
 
-UNSUBSCRIBE_ERRORS = ['blocked', 'rights', 'kicked', 'not a member']
+# Bad requests with these errors mean that the chat is gone, all forbidden requests mean the same
+UNSUBSCRIBE_ERRORS = ['chat not found', 'blocked', 'rights', 'kicked', 'not a member', 'deactivated']
 MAX_BUTTONS_COUNT = 60
 MAX_MESSAGE_LENGTH = 4096
+MAX_CALLBACK_DATA_LENGTH = 64
+API_RETRIES = 3
+BROADCAST_WORKERS = 8
+NOTIFICATIONS_POLL_PERIOD = 5
 
 
 class Bot:
@@ -34,9 +52,37 @@ class Bot:
             self.__logs_dir_name = config.get('logs_dir_name', 'logs')
             self.__tests_dir_name = config.get('tests_dir_name', 'tests')
             self.__results_file_name = config.get('results_file_name', 'results.json')
-
-        self.__db = DB(config.get('telegram_db', {}))
-        self.__bot = TeleBot(self.__token)
+            self.__results_store = ResultsStore(config.get(
+                'results_db_path',
+                os.path.join(self.__archive_dir_path, 'results.db'),
+            ))
+            self.__archive = Archive(
+                archive_dir_path=self.__archive_dir_path,
+                results_file_name=self.__results_file_name,
+                log_func=logger.info,
+            )
+            self.__archive_index = ArchiveIndex(self.__archive, config.get('archive_poll_period', 5))
+            self.__log_index = LogIndex(
+                config.get('log_index_db_path', os.path.join(self.__archive_dir_path, 'logs_index.db')),
+                log_func=logger.info,
+            )
+            self.__cache = MtimeCache(config.get('results_cache_size', 128))
+            self.__broadcast_workers = config.get('broadcast_workers', BROADCAST_WORKERS)
+            self.__notifications_poll_period = config.get('notifications_poll_period', NOTIFICATIONS_POLL_PERIOD)
+            self.__threads = config.get('telegram_threads', 2)
+            # Bot gets updates by long polling, if webhook isn't set
+            self.__webhook = config.get('telegram_webhook')
+
+            # Another API server is used by the local Bot API server or by a fake server in tests
+            telegram_api_url = config.get('telegram_api_url')
+            if telegram_api_url is not None:
+                apihelper.API_URL = telegram_api_url
+
+        # Handlers threads, notifications thread and the main thread use DB at the same time
+        self.__db = DB(config.get('telegram_db', {}), min_connections=self.__threads + 2)
+        self.__bot = TeleBot(self.__token, num_threads=self.__threads)
+        self.__rate_limiter = RateLimiter()
+        self.__stop_event = threading.Event()
         self.__username = f'@{self.__bot.get_me().username}'
         self.__init_handlers()
 
@@ -44,14 +90,21 @@ class Bot:
     # Handlers
     #########################
 
+    def __with_connection(self, handler):
+        # Connection is returned to the pool after every handler, otherwise handlers threads keep them forever
+        def wrapper(*args, **kwargs):
+            with self.__db.connection():
+                return handler(*args, **kwargs)
+        return wrapper
+
     def __add_message_handler(self, handler, *args, **kwargs):
-        self.__bot.message_handler(*args, **kwargs)(handler)
+        self.__bot.message_handler(*args, **kwargs)(self.__with_connection(handler))
 
     def __add_channel_post_handler(self, handler, *args, **kwargs):
-        self.__bot.channel_post_handler(*args, **kwargs)(handler)
+        self.__bot.channel_post_handler(*args, **kwargs)(self.__with_connection(handler))
 
     def __add_callback_query_handler(self, handler, *args, **kwargs):
-        self.__bot.callback_query_handler(*args, **kwargs)(handler)
+        self.__bot.callback_query_handler(*args, **kwargs)(self.__with_connection(handler))
 
     def __init_handlers(self):
         self.__add_message_handler(commands=['start'], handler=self.__show_info)
@@ -66,6 +119,7 @@ class Bot:
         self.__add_channel_post_handler(commands=['unsubscribe'], handler=self.__unsubscribe)
 
         self.__add_message_handler(commands=['show_results'], handler=self.__send_results_list_command)
+        self.__add_message_handler(commands=['search'], handler=self.__search)
 
         self.__add_callback_query_handler(
             func=lambda call: call.data.startswith('results_list;'),
@@ -93,6 +147,10 @@ class Bot:
             func=lambda call: call.data.startswith('log;'),
             handler=self.__send_log,
         )
+        self.__add_callback_query_handler(
+            func=lambda call: call.data.startswith('full_log;'),
+            handler=self.__send_full_log_call,
+        )
 
         self.__add_callback_query_handler(
             func=lambda call: call.data.startswith('tests;all;'),
@@ -108,7 +166,25 @@ class Bot:
         )
 
     def start(self):
-        self.__bot.infinity_polling()
+        self.__archive_index.start()
+        notifications_thread = threading.Thread(target=self.__send_notifications, name='Notifications', daemon=True)
+        notifications_thread.start()
+        try:
+            if self.__webhook:
+                WebhookServer(
+                    bot=self.__bot,
+                    url=self.__webhook['url'],
+                    host=self.__webhook.get('host', '127.0.0.1'),
+                    port=self.__webhook.get('port', 8080),
+                    path=self.__webhook.get('path', '/webhook'),
+                    secret_token=self.__webhook.get('secret_token'),
+                ).serve()
+            else:
+                self.__bot.infinity_polling()
+        finally:
+            self.__stop_event.set()
+            self.__archive_index.stop()
+            notifications_thread.join()
 
     #########################
     # Data transformation
@@ -165,23 +241,80 @@ class Bot:
                 builds_names.append(f'{os_name}_{build_name}')
         return builds_names
 
-    def __get_files(self, dir_path, results_path=None):
-        if not os.path.exists(dir_path):
-            return []
+    def __load_run_results(self, dir_name):
+        run_id = self.__results_store.get_run_id(dir_name)
+        if run_id is not None:
+            return self.__results_store.get_results(run_id)
 
-        # Use results_path argument to filter by failed results
-        if not results_path or not os.path.exists(results_path):
-            return os.listdir(dir_path)
+        # Runs archived before results store was used have only results file
+        data = self.__archive.read_file(dir_name, self.__results_file_name)
+        if data is None:
+            return None
 
-        with open(results_path, mode='r') as fs:
-            results = json.load(fs)
-            failed_builds = self.__get_builds_names(results, only_failed=True)
+        return json.loads(data)
+
+    def __get_run_results(self, dir_name):
+        return self.__cache.get(
+            key=('results', dir_name),
+            version=self.__archive.get_mtime(dir_name, self.__results_file_name),
+            loader=lambda: self.__load_run_results(dir_name),
+        )
+
+    def __get_clusters(self, dir_name):
+        data = self.__archive.read_file(dir_name, SIGNATURES_FILE_NAME)
+        if data is None:
+            return None
+
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            logger.error(f'Impossible to load failure signatures of run {dir_name}:\n{e}')
+            return None
+
+    def __get_failed_builds(self, dir_name):
+        def load():
+            results = self.__get_run_results(dir_name)
+            if results is None:
+                return None
+            return set(self.__get_builds_names(results, only_failed=True))
+
+        return self.__cache.get(
+            key=('failed', dir_name),
+            version=self.__archive.get_mtime(dir_name, self.__results_file_name),
+            loader=load,
+        )
+
+    def __load_files(self, date_name, dir_name, only_failed=False):
+        run_id = self.__results_store.get_run_id(date_name)
+        if run_id is not None:
+            column = 'log_path' if dir_name == self.__logs_dir_name else 'tests_path'
+            files = self.__results_store.get_builds_files(
+                run_id, column,
+                results=FAILED_RESULTS if only_failed else None,
+            )
+            return list(map(os.path.basename, files))
+
+        files = self.__archive.list_files(date_name, dir_name)
+        if not files:
+            return []
+
+        # Use results to filter by failed results
+        failed_builds = self.__get_failed_builds(date_name)
+        if not only_failed or failed_builds is None:
+            return files
 
         return list(filter(
             lambda build: os.path.splitext(build)[0] in failed_builds,
-            os.listdir(dir_path),
+            files,
         ))
 
+    def __get_files(self, date_name, dir_name, only_failed=False):
+        return self.__cache.get(
+            key=('files', date_name, dir_name, only_failed),
+            version=self.__archive.get_mtime(date_name, dir_name),
+            loader=lambda: self.__load_files(date_name, dir_name, only_failed),
+        )
+
     @staticmethod
     def __get_page(data_list, reverse=False, data_handler=None, count=10, page=1):
         new_data = []
@@ -225,6 +358,26 @@ class Bot:
             page=page,
         )
 
+        return self.__get_page_keyboard(
+            page_data=page_data,
+            is_end=is_end,
+            row_width=row_width,
+            data_handler=data_handler,
+            prefix=prefix,
+            page=page,
+            pages_prefix=pages_prefix,
+        )
+
+    @staticmethod
+    def __get_page_keyboard(
+        page_data,
+        is_end,
+        row_width=1,
+        data_handler=None,
+        prefix='',
+        page=0,
+        pages_prefix=None,
+    ):
         if len(page_data) == 0:
             return
 
@@ -261,20 +414,49 @@ class Bot:
 
         return keyboard
 
+    @staticmethod
+    def __get_result_line(os_name, build_name, result):
+        if result not in SUCCESS_RESULTS:
+            result = f'*{result}*'
+        line = f'OS: {os_name}. Build: {build_name}. Result: {result}\n'
+        return line.replace('_', '\\_')  # escape markdown special symbol
+
     @classmethod
-    def __get_results_message(cls, results, only_failed=False):
+    def __get_results_message(cls, results, only_failed=False, clusters=None):
         if only_failed:
             results = cls.__get_failed_results(results)
 
-        message = ''
+        lines = []
+        grouped_builds = set()
+        # Failed builds with the same cause of the failure in logs are shown together
+        for cluster in clusters or []:
+            builds = [
+                (os_name, build_name)
+                for os_name, build_name in cluster['builds']
+                if build_name in results.get(os_name, {})
+            ]
+            if not builds:
+                continue
+
+            signature = re.sub(r'([_*`\[])', r'\\\1', cluster['signature'])
+            lines.append(f'Cause ({len(builds)} builds): {signature}\n')
+            for os_name, build_name in builds:
+                lines.append(cls.__get_result_line(os_name, build_name, results[os_name][build_name]))
+                grouped_builds.add((os_name, build_name))
+            lines.append('\n')
+
         for os_name, builds in results.items():
+            builds = {
+                build_name: result
+                for build_name, result in builds.items()
+                if (os_name, build_name) not in grouped_builds
+            }
+            if not builds:
+                continue
             for build_name, result in builds.items():
-                if result not in SUCCESS_RESULTS:
-                    result = f'*{result}*'
-                message += f'OS: {os_name}. Build: {build_name}. Result: {result}\n'
-            message += '\n'
-        message = message.replace('_', '\\_')  # escape markdown special symbol
-        return message
+                lines.append(cls.__get_result_line(os_name, build_name, result))
+            lines.append('\n')
+        return ''.join(lines)
 
     @staticmethod
     def __get_results_keyboard(dir_name, only_failed=False):
@@ -294,17 +476,13 @@ class Bot:
         if text[-1] != '\n':
             text += '\n'
 
+        # Every message ends with the last line break that fits to the message, long lines are cut
         while begin < len(text):
-            i = 0
             max_len = min(MAX_MESSAGE_LENGTH - 1, len(text) - begin - 1)
-            for i in range(max_len, -1, -1):
-                if text[begin + i] == '\n':
-                    break
-            if i == 0:
-                i = max_len
-            i += 1
-            messages.append(text[begin:begin + i])
-            begin += i
+            end = text.rfind('\n', begin + 1, begin + max_len + 1)
+            length = (end - begin if end != -1 else max_len) + 1
+            messages.append(text[begin:begin + length])
+            begin += length
 
         return messages
 
@@ -325,26 +503,74 @@ class Bot:
 
         return reply_markups
 
-    def __send_message(self, chat_id, text, **kwargs):
-        reply_markups = self.__split_reply_markup(kwargs.get('reply_markup'))
+    def __call_api(self, method, chat_id, *args, **kwargs):
+        for attempt in range(API_RETRIES):
+            self.__rate_limiter.acquire(chat_id)
+            try:
+                return method(chat_id, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == API_RETRIES - 1:
+                    raise
+                # All calls are paused, because the limit is exceeded for the whole bot
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                logger.warning(f'Too many requests to Telegram API, retry after {retry_after} sec')
+                self.__rate_limiter.pause(retry_after)
+
+    @classmethod
+    def __render_message(cls, text, **kwargs):
+        """Splits the message to payloads of API calls, so they can be sent to any number of chats."""
+        reply_markups = [
+            reply_markup.to_json() if isinstance(reply_markup, types.JsonSerializable) else reply_markup
+            for reply_markup in cls.__split_reply_markup(kwargs.get('reply_markup'))
+        ]
         kwargs['reply_markup'] = None
 
-        messages = self.__split_message(text)
+        messages = cls.__split_message(text)
+        payloads = []
 
         if len(messages) > 1:
-            self.__bot.send_message(chat_id, messages[0], **kwargs)
+            payloads.append({**kwargs, 'text': messages[0]})
             kwargs['reply_to_message_id'] = None
 
         for i in range(1, len(messages) - 1):
-            self.__bot.send_message(chat_id, messages[i], **kwargs)
+            payloads.append({**kwargs, 'text': messages[i]})
 
         kwargs['reply_markup'] = reply_markups[0]
-        self.__bot.send_message(chat_id, messages[-1], **kwargs)
+        payloads.append({**kwargs, 'text': messages[-1]})
 
         last_line = messages[-1].strip('\n').split('\n')[-1]
         for i in range(1, len(reply_markups)):
             kwargs['reply_markup'] = reply_markups[i]
-            self.__bot.send_message(chat_id, f'Page #{i + 1}. {last_line}', **kwargs)
+            payloads.append({**kwargs, 'text': f'Page #{i + 1}. {last_line}'})
+
+        return payloads
+
+    def __send_payloads(self, chat_id, payloads):
+        for payload in payloads:
+            self.__call_api(self.__bot.send_message, chat_id, **payload)
+
+    def __send_message(self, chat_id, text, **kwargs):
+        self.__send_payloads(chat_id, self.__render_message(text, **kwargs))
+
+    def __get_results_payloads(self, dir_name, results, title, only_failed=False):
+        """Returns rendered results of the run (cached with the run) or None if there are no results to show."""
+        def render():
+            clusters = self.__get_clusters(dir_name) if only_failed else None
+            message = self.__get_results_message(results, only_failed=only_failed, clusters=clusters)
+            if not message:
+                return None
+
+            return self.__render_message(
+                text=f'{title}:\n\n{message}',
+                reply_markup=self.__get_results_keyboard(dir_name, only_failed=only_failed),
+                parse_mode='Markdown',
+            )
+
+        return self.__cache.get(
+            key=('payloads', dir_name, title, only_failed),
+            version=self.__archive.get_mtime(dir_name, self.__results_file_name),
+            loader=render,
+        )
 
     #########################
     # Commands
@@ -359,6 +585,7 @@ class Bot:
             • /subscribe_to_failures to subscribe only for failed build checks;
             • /unsubscribe to unsubscribe from all results of builds.
             • /show_results to show results from archive.
+            • /search <text> to find lines with the text in logs from archive.
         '''))
 
     def __subscribe(self, message):
@@ -399,15 +626,12 @@ class Bot:
     #########################
 
     def __send_results_list(self, user_id, page):
-        archive_files = []
-        if os.path.exists(self.__archive_dir_path):
-            archive_files = os.listdir(self.__archive_dir_path)
-
-        keyboard = self.__get_names_keyboard(
-            data_list=archive_files,
-            reverse=True,
+        page_data, is_end = self.__archive_index.get_page(count=6, page=page)
+        keyboard = self.__get_page_keyboard(
+            page_data=page_data,
+            is_end=is_end,
             row_width=2,
-            data_handler=self.__dir_name_to_date,
+            data_handler=self.__archive_index.get_label,
             prefix=f'results;failed;',
             page=page,
             pages_prefix='results_list;',
@@ -440,37 +664,60 @@ class Bot:
         self.__bot.answer_callback_query(callback_query_id=call.id)
         self.__send_results_list(call.from_user.id, page)
 
+    #########################
+    # Search
+    #########################
+
+    def __search(self, message):
+        words = message.text.split(maxsplit=1)
+        if len(words) < 2:
+            self.__send_message(
+                chat_id=message.chat.id,
+                text='Use `/search <text>` to search in logs',
+                parse_mode='Markdown',
+            )
+            return
+
+        results = self.__log_index.search(words[1])
+        if not results:
+            self.__send_message(chat_id=message.chat.id, text='Nothing is found in logs!')
+            return
+
+        lines = []
+        for result in results:
+            lines.append(
+                f'{self.__dir_name_to_date(result.dir_name)}. {self.__file_name_to_os_build_str(result.log_name)}. '
+                f'Line {result.line_no}:\n{result.line}\n\n'
+            )
+        self.__send_message(chat_id=message.chat.id, text=''.join(lines))
+
     #########################
     # Results
     #########################
 
     def __send_results(self, call, only_failed=False):
         dir_name = call.data.split(';')[-1]
-        results_file = os.path.join(self.__archive_dir_path, dir_name, self.__results_file_name)
-        if not os.path.exists(results_file):
+        results = self.__get_run_results(dir_name)
+        if results is None:
             self.__bot.answer_callback_query(callback_query_id=call.id, text='No results file for selected time!')
             return
 
         self.__bot.answer_callback_query(callback_query_id=call.id)
-        with open(results_file, mode='r') as fs:
-            results = json.load(fs)
-            keyboard = self.__get_results_keyboard(dir_name, only_failed=only_failed)
-            message = self.__get_results_message(results, only_failed=only_failed)
-            if message:
-                prefix = 'Failed' if only_failed else 'All'
-                self.__send_message(
-                    chat_id=call.from_user.id,
-                    text=f'{prefix} results from {self.__dir_name_to_date(dir_name)}:\n\n{message}',
-                    reply_markup=keyboard,
-                    parse_mode='Markdown',
-                )
-            else:
-                prefix = 'failed' if only_failed else ''
-                self.__send_message(
-                    chat_id=call.from_user.id,
-                    text=f'No {prefix} results from {self.__dir_name_to_date(dir_name)}!',
-                    reply_markup=keyboard,
-                )
+        prefix = 'Failed' if only_failed else 'All'
+        payloads = self.__get_results_payloads(
+            dir_name, results,
+            title=f'{prefix} results from {self.__dir_name_to_date(dir_name)}',
+            only_failed=only_failed,
+        )
+        if payloads:
+            self.__send_payloads(call.from_user.id, payloads)
+        else:
+            prefix = 'failed' if only_failed else ''
+            self.__send_message(
+                chat_id=call.from_user.id,
+                text=f'No {prefix} results from {self.__dir_name_to_date(dir_name)}!',
+                reply_markup=self.__get_results_keyboard(dir_name, only_failed=only_failed),
+            )
 
     def __send_failed_results(self, call):
         self.__send_results(call, only_failed=True)
@@ -484,13 +731,7 @@ class Bot:
 
     def __send_build_files(self, call, type_name, dir_name, only_failed=False):
         date_name = call.data.split(';')[-1]
-        date_dir_path = os.path.join(self.__archive_dir_path, date_name, dir_name)
-
-        if only_failed:
-            results_path = os.path.join(self.__archive_dir_path, date_name, self.__results_file_name)
-            files = self.__get_files(date_dir_path, results_path)
-        else:
-            files = self.__get_files(date_dir_path)
+        files = self.__get_files(date_name, dir_name, only_failed=only_failed)
 
         if len(files) == 0 and not only_failed:
             self.__bot.answer_callback_query(callback_query_id=call.id, text=f'No {type_name}s for selected date!')
@@ -528,20 +769,79 @@ class Bot:
     def __send_all_logs(self, call):
         return self.__send_build_files(call, 'log', self.__logs_dir_name, only_failed=False)
 
+    def __send_log_document(self, chat_id, dir_name, fs):
+        def send_document(chat_id):
+            # File is read again when the call is retried
+            fs.seek(0)
+            return self.__bot.send_document(
+                chat_id,
+                data=fs,
+                caption=f'Logs from {self.__dir_name_to_date(dir_name)}',
+            )
+
+        with fs:
+            self.__call_api(send_document, chat_id)
+
+    def __get_full_log_callback_data(self, dir_name, file_name):
+        # Callback data is limited by 64 bytes, so the log is referred by id of the build, when it's known
+        run_id = self.__results_store.get_run_id(dir_name)
+        if run_id is not None:
+            build_id = self.__results_store.get_build_id(
+                run_id, 'log_path', os.path.join(self.__logs_dir_name, file_name),
+            )
+            if build_id is not None:
+                return f'full_log;{build_id}'
+
+        callback_data = f'full_log;{dir_name};{file_name}'
+        if len(callback_data.encode()) <= MAX_CALLBACK_DATA_LENGTH:
+            return callback_data
+
     def __send_log(self, call):
         dir_name, file_name = call.data.split(';')[1:]
-        log_file = os.path.join(self.__archive_dir_path, dir_name, self.__logs_dir_name, file_name)
-        if not os.path.exists(log_file):
+        excerpt_path, _ = get_digest_paths(file_name)
+        excerpt = self.__archive.read_file(dir_name, excerpt_path)
+        if excerpt is None:
+            return self.__send_full_log(call, dir_name, file_name)
+
+        self.__bot.answer_callback_query(callback_query_id=call.id)
+        keyboard = None
+        callback_data = self.__get_full_log_callback_data(dir_name, file_name)
+        if callback_data is not None:
+            keyboard = types.InlineKeyboardMarkup()
+            keyboard.add(types.InlineKeyboardButton(text='Get full log', callback_data=callback_data))
+        self.__send_message(
+            chat_id=call.from_user.id,
+            text=f'{self.__file_name_to_os_build_str(file_name)}\n'
+                 f'Time: {self.__dir_name_to_date(dir_name)}\n\n'
+                 f'{excerpt.decode(errors="replace")}',
+            reply_markup=keyboard,
+        )
+
+    def __send_full_log_call(self, call):
+        params = call.data.split(';')[1:]
+        if len(params) == 2:
+            return self.__send_full_log(call, *params)
+
+        build = self.__results_store.get_build(int(params[0])) if params[0].isdigit() else None
+        if build is None or build['dir_name'] is None or build['log_path'] is None:
+            self.__bot.answer_callback_query(callback_query_id=call.id, text='No logs for selected build!')
+            return
+
+        return self.__send_full_log(call, build['dir_name'], os.path.basename(build['log_path']))
+
+    def __send_full_log(self, call, dir_name, file_name):
+        # Compressed copy is sent if it's made when the run is archived
+        _, gzip_path = get_digest_paths(file_name)
+        fs = self.__archive.open_file(dir_name, gzip_path)
+        if fs is None:
+            fs = self.__archive.open_file(dir_name, os.path.join(self.__logs_dir_name, file_name))
+
+        if fs is None:
             self.__bot.answer_callback_query(callback_query_id=call.id, text='No logs for selected build!')
             return
 
         self.__bot.answer_callback_query(callback_query_id=call.id)
-        with open(log_file, mode='r') as fs:
-            self.__bot.send_document(
-                chat_id=call.from_user.id,
-                data=fs,
-                caption=f'Logs from {self.__dir_name_to_date(dir_name)}',
-            )
+        self.__send_log_document(call.from_user.id, dir_name, fs)
 
     #########################
     # Tests
@@ -553,64 +853,166 @@ class Bot:
     def __send_all_tests(self, call):
         return self.__send_build_files(call, 'test', self.__tests_dir_name, only_failed=False)
 
+    def __load_tests(self, dir_name, file_name):
+        run_id = self.__results_store.get_run_id(dir_name)
+        if run_id is not None:
+            tests = self.__results_store.get_tests(run_id, os.path.join(self.__tests_dir_name, file_name))
+            if tests:
+                return tests
+
+        data = self.__archive.read_file(dir_name, os.path.join(self.__tests_dir_name, file_name))
+        if data is None:
+            return None
+
+        return json.loads(data)
+
+    def __get_tests(self, dir_name, file_name):
+        return self.__cache.get(
+            key=('tests', dir_name, file_name),
+            version=self.__archive.get_mtime(dir_name, os.path.join(self.__tests_dir_name, file_name)),
+            loader=lambda: self.__load_tests(dir_name, file_name),
+        )
+
     def __send_test(self, call):
         dir_name, file_name = call.data.split(';')[1:]
-        test_file = os.path.join(self.__archive_dir_path, dir_name, self.__tests_dir_name, file_name)
-        if not os.path.exists(test_file):
+        tests = self.__get_tests(dir_name, file_name)
+        if tests is None:
             self.__bot.answer_callback_query(callback_query_id=call.id, text='No tests for selected build!')
             return
 
         self.__bot.answer_callback_query(callback_query_id=call.id)
-        with open(test_file, mode='r') as fs:
-            tests = json.load(fs)
 
-            message = ''
-            for test_name, result in tests.items():
-                message += f'- {test_name}: {result}\n'
+        message = ''
+        for test_name, result in tests.items():
+            message += f'- {test_name}: {result}\n'
 
-            os_name, build_name = self.__file_name_to_os_build(test_file)
-            self.__send_message(
-                chat_id=call.from_user.id,
-                text=f'OS: {os_name}\n'
-                     f'Build Name: {build_name}\n'
-                     f'Time: {self.__dir_name_to_date(dir_name)}\n\n'
-                     f'Tests results:\n'
-                     f'{message}',
-            )
+        os_name, build_name = self.__file_name_to_os_build(file_name)
+        self.__send_message(
+            chat_id=call.from_user.id,
+            text=f'OS: {os_name}\n'
+                 f'Build Name: {build_name}\n'
+                 f'Time: {self.__dir_name_to_date(dir_name)}\n\n'
+                 f'Tests results:\n'
+                 f'{message}',
+        )
 
     #########################
     # Subscription
     #########################
 
-    def __send_message_to_subscriber(self, chat_id, *args, **kwargs):
+    @staticmethod
+    def __is_chat_gone(e: ApiTelegramException):
+        if e.error_code == 403:
+            return True
+        if e.error_code != 400:
+            return False
+
+        description = e.result_json.get('description', '').lower()
+        return any(map(lambda error: error in description, UNSUBSCRIBE_ERRORS))
+
+    def __send_payloads_to_subscriber(self, chat_id, payloads, dead_chat_ids):
         try:
-            return self.__send_message(chat_id, *args, **kwargs)
+            self.__send_payloads(chat_id, payloads)
+            return True
         except ApiTelegramException as e:
             logger.error(e)
-            if any(map(
-                lambda error: error in e.result_json['description'] or e.error_code == 403,
-                UNSUBSCRIBE_ERRORS,
-            )):
+            if self.__is_chat_gone(e):
                 logger.warning(f'Unsubscribe {chat_id} because specific error')
-                self.__db.unsubscribe(chat_id)
+                dead_chat_ids.append(chat_id)
+                # Nothing can be delivered to this chat anymore
+                return True
         except Exception as e:
             logger.error(e)
 
-    def send_out_builds_info(self, builds_info, dir_name):
-        failed_message = self.__get_results_message(builds_info, only_failed=True)
-        keyboard = self.__get_results_keyboard(dir_name, only_failed=True)
-        if failed_message:
-            for chat_id in self.__db.get_subscribers_for_failed():
-                self.__send_message_to_subscriber(
-                    chat_id=chat_id,
-                    text=f'Some builds are failed:\n\n{failed_message}',
-                    reply_markup=keyboard,
-                    parse_mode='Markdown',
-                )
+        return False
+
+    def __broadcast(self, chat_ids, payloads):
+        """Returns chats the payloads aren't delivered to, except chats which are unsubscribed."""
+        if not chat_ids:
+            return []
+
+        # Messages to one chat are sent by one worker, so they keep their order
+        start = time.time()
+        dead_chat_ids = []
+        with ThreadPoolExecutor(max_workers=min(len(chat_ids), self.__broadcast_workers)) as executor:
+            is_done = list(executor.map(
+                lambda chat_id: self.__send_payloads_to_subscriber(chat_id, payloads, dead_chat_ids),
+                chat_ids,
+            ))
+
+        # Dead chats are unsubscribed by one query after all messages are sent
+        self.__db.unsubscribe_many(dead_chat_ids)
+
+        failed_chat_ids = [chat_id for chat_id, is_chat_done in zip(chat_ids, is_done) if not is_chat_done]
+        delivered = len(chat_ids) - len(failed_chat_ids) - len(dead_chat_ids)
+        elapsed_time = time.time() - start
+        logger.info(
+            f'Builds info is delivered to {delivered} of {len(chat_ids)} chats in {elapsed_time:.2f} sec '
+            f'({delivered / elapsed_time if elapsed_time else 0:.2f} chats/sec)'
+        )
+        return failed_chat_ids
+
+    def send_out_builds_info(self, builds_info, dir_name, chat_ids=None):
+        """
+        Sends builds info to subscribers (only to ones of `chat_ids`, if they are passed)
+        and returns chats it isn't delivered to, e.g. when Telegram is unavailable.
+        """
+        # Messages are rendered once for all subscribers
+        payloads = self.__get_results_payloads(dir_name, builds_info, title='Some builds are failed', only_failed=True)
+        if payloads:
+            subscribers = self.__db.get_subscribers_for_failed()
         else:
-            for chat_id in self.__db.get_subscribers_for_all():
-                self.__send_message_to_subscriber(
-                    chat_id=chat_id,
-                    text='All tests are passed!',
-                    reply_markup=keyboard,
-                )
+            subscribers = self.__db.get_subscribers_for_all()
+            payloads = self.__render_message(
+                text='All tests are passed!',
+                reply_markup=self.__get_results_keyboard(dir_name, only_failed=True),
+            )
+
+        if chat_ids is not None:
+            # Chats unsubscribed since the previous attempt are skipped
+            chat_ids = set(chat_ids)
+            subscribers = [chat_id for chat_id in subscribers if chat_id in chat_ids]
+
+        return self.__broadcast(subscribers, payloads)
+
+    #########################
+    # Notifications queue
+    #########################
+
+    def __send_notification(self, notification):
+        try:
+            failed_chat_ids = self.send_out_builds_info(
+                json.loads(notification.builds_info),
+                notification.dir_name,
+                chat_ids=self.__db.get_notification_chat_ids(notification),
+            )
+        except Exception as e:
+            logger.error(f'Impossible to send notification about {notification.dir_name}:\n{e}')
+            self.__db.mark_notification_failed(notification, e)
+            return
+
+        if failed_chat_ids:
+            logger.error(f'Notification about {notification.dir_name} is not delivered to {len(failed_chat_ids)} chats')
+            # Next attempts are made only for chats which haven't got the notification
+            self.__db.mark_notification_failed(
+                notification,
+                f'Not delivered to {len(failed_chat_ids)} chats',
+                chat_ids=failed_chat_ids,
+            )
+            return
+
+        self.__db.mark_notification_sent(notification)
+
+    def send_pending_notifications(self):
+        with self.__db.connection():
+            for notification in self.__db.get_pending_notifications():
+                self.__send_notification(notification)
+
+    def __send_notifications(self):
+        # Notifications are enqueued by check.py, so the check doesn't depend on Telegram availability
+        while not self.__stop_event.is_set():
+            try:
+                self.send_pending_notifications()
+            except Exception as e:
+                logger.error(f'Impossible to get notifications:\n{e}')
+            self.__stop_event.wait(self.__notifications_poll_period)
@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+
+class MtimeCache:
+    """
+    Bounded LRU cache of values loaded from files.
+
+    Every value is stored with the version of its source (usually mtime of the file),
+    the value is loaded again when the version is changed. Cached values are shared,
+    so they must not be changed by callers.
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+
+        self.__lock = threading.Lock()
+        self.__items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, loader):
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is not None and item[0] == version:
+                self.__items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+
+        self.misses += 1
+        value = loader()
+        # Values of missing sources aren't cached, they may appear later with the same version
+        if version is None:
+            return value
+
+        with self.__lock:
+            self.__items[key] = (version, value)
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.max_size:
+                self.__items.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
@@ -1,12 +1,22 @@
+import json
+import threading
+import time
 from enum import Enum
 
 from peewee import (
     Model,
     SqliteDatabase,
-    PostgresqlDatabase,
     AutoField,
     IntegerField,
+    CharField,
+    TextField,
+    FloatField,
 )
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.pool import PooledPostgresqlDatabase
+
+NOTIFICATION_MAX_ATTEMPTS = 10
+NOTIFICATION_RETRY_DELAY = 30
 
 
 class SubscribeType(Enum):
@@ -14,8 +24,14 @@ class SubscribeType(Enum):
     FAILED = 1
 
 
+class NotificationStatus(Enum):
+    PENDING = 0
+    SENT = 1
+    DEAD = 2
+
+
 class DB:
-    def __init__(self, config):
+    def __init__(self, config, min_connections=1):
         db_name = config.get('name')
         if db_name is None:
             db_file = config.get('file')
@@ -25,7 +41,14 @@ class DB:
         else:
             db_user = config.get('user', 'delivery_checker_bot')
             db_password = config.get('password')
-            db = PostgresqlDatabase(db_name, user=db_user, password=db_password)
+            db = PooledPostgresqlDatabase(
+                db_name,
+                user=db_user,
+                password=db_password,
+                # Every thread working with DB takes its own connection from the pool
+                max_connections=max(config.get('max_connections', 8), min_connections),
+                stale_timeout=config.get('stale_timeout', 300),
+            )
 
         class BaseModel(Model):
             class Meta:
@@ -36,35 +59,130 @@ class DB:
             chat_id = IntegerField(unique=True)
             subscribe_type = IntegerField()
 
+        class Notification(BaseModel):
+            id = AutoField()
+            dir_name = CharField()
+            builds_info = TextField()
+            status = IntegerField(default=NotificationStatus.PENDING.value, index=True)
+            attempts = IntegerField(default=0)
+            next_attempt_at = FloatField(default=0)
+            created_at = FloatField()
+            last_error = TextField(null=True)
+            # Chats the notification isn't delivered to yet, all subscribers are recipients of the first attempt
+            chat_ids = TextField(null=True)
+
+        self.database = db
         self.User = User
-        self.User.create_table()
+        self.Notification = Notification
+        with self.connection():
+            self.User.create_table()
+            self.Notification.create_table()
+            self.__migrate()
 
-    def subscribe(self, chat_id: int, subscribe_type: SubscribeType):
-        user = self.User.get_or_none(self.User.chat_id == chat_id)
-        if user is not None:
-            user.subscribe_type = subscribe_type.value
-            user.save()
-        else:
-            user = self.User(
-                chat_id=chat_id,
-                subscribe_type=subscribe_type.value,
-            )
-            user.save()
+        # Subscribers by subscribe types, cache is cleared on every change of subscriptions
+        self.__lock = threading.Lock()
+        self.__subscribers = None
+
+    def __migrate(self):
+        # Columns added to tables of existing databases
+        table_name = self.Notification._meta.table_name
+        columns = set(map(lambda column: column.name, self.database.get_columns(table_name)))
+        if 'chat_ids' not in columns:
+            migrate(SchemaMigrator.from_database(self.database).add_column(
+                table_name, 'chat_ids', self.Notification.chat_ids,
+            ))
+
+    def connection(self):
+        """Context to use one connection and return it to the pool (or close it) at the end."""
+        return self.database.connection_context()
+
+    def __clear_subscribers(self):
+        with self.__lock:
+            self.__subscribers = None
 
-        return user
+    def __get_subscribers(self):
+        with self.__lock:
+            if self.__subscribers is None:
+                subscribers = {subscribe_type: [] for subscribe_type in SubscribeType}
+                for user in self.User.select(self.User.chat_id, self.User.subscribe_type):
+                    subscribers[SubscribeType(user.subscribe_type)].append(user.chat_id)
+                self.__subscribers = subscribers
+            return self.__subscribers
+
+    def subscribe(self, chat_id: int, subscribe_type: SubscribeType):
+        self.User.insert(
+            chat_id=chat_id,
+            subscribe_type=subscribe_type.value,
+        ).on_conflict(
+            conflict_target=[self.User.chat_id],
+            preserve=[self.User.subscribe_type],
+        ).execute()
+        self.__clear_subscribers()
 
     def unsubscribe(self, chat_id: int):
-        test = self.User.delete().where(self.User.chat_id == chat_id)
-        return test.execute()
+        return self.unsubscribe_many([chat_id])
+
+    def unsubscribe_many(self, chat_ids):
+        if not chat_ids:
+            return 0
+
+        deleted = self.User.delete().where(self.User.chat_id.in_(list(chat_ids))).execute()
+        self.__clear_subscribers()
+        return deleted
 
     def get_subscribers_for_all(self):
-        users = []
-        for user in self.User.select(self.User.chat_id).where(self.User.subscribe_type == SubscribeType.ALL.value):
-            users.append(user.chat_id)
-        return users
+        return list(self.__get_subscribers()[SubscribeType.ALL])
 
     def get_subscribers_for_failed(self):
-        users = []
-        for user in self.User.select(self.User.chat_id):
-            users.append(user.chat_id)
-        return users
+        subscribers = self.__get_subscribers()
+        return subscribers[SubscribeType.ALL] + subscribers[SubscribeType.FAILED]
+
+    def enqueue_notification(self, dir_name, builds_info):
+        notification = self.Notification(
+            dir_name=dir_name,
+            builds_info=json.dumps(builds_info),
+            created_at=time.time(),
+        )
+        notification.save()
+        return notification
+
+    def get_pending_notifications(self, limit=10):
+        return list(
+            self.Notification
+            .select()
+            .where(
+                (self.Notification.status == NotificationStatus.PENDING.value) &
+                (self.Notification.next_attempt_at <= time.time())
+            )
+            .order_by(self.Notification.id)
+            .limit(limit)
+        )
+
+    def mark_notification_sent(self, notification):
+        notification.status = NotificationStatus.SENT.value
+        notification.attempts += 1
+        notification.last_error = None
+        notification.save()
+
+    @staticmethod
+    def get_notification_chat_ids(notification):
+        """Returns chats the notification isn't delivered to yet or None, if it's not sent to anybody yet."""
+        if notification.chat_ids is None:
+            return None
+        return json.loads(notification.chat_ids)
+
+    def mark_notification_failed(self, notification, error, chat_ids=None,
+                                 max_attempts=NOTIFICATION_MAX_ATTEMPTS, retry_delay=NOTIFICATION_RETRY_DELAY):
+        """
+        Postpones the notification with exponential backoff or moves it to dead letters after all attempts.
+        Next attempts send the notification only to `chat_ids`, if they are passed.
+        """
+        notification.attempts += 1
+        notification.last_error = str(error)
+        if chat_ids is not None:
+            notification.chat_ids = json.dumps(list(chat_ids))
+        if notification.attempts >= max_attempts:
+            notification.status = NotificationStatus.DEAD.value
+        else:
+            notification.next_attempt_at = time.time() + retry_delay * 2 ** (notification.attempts - 1)
+        notification.save()
@@ -0,0 +1,71 @@
+import threading
+import time
+
+# Telegram limits: about 30 messages per second for all chats, 1 per second for a chat and 20 per minute for a group
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+GROUP_RATE = 20 / 60
+BURST_SIZE = 3
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+
+        self.__lock = threading.Lock()
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+
+    def __reserve(self):
+        """Takes a token and returns time to wait before it can be used."""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+
+            self.__tokens -= 1
+            if self.__tokens >= 0:
+                return 0
+            return -self.__tokens / self.rate
+
+    def acquire(self):
+        delay = self.__reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """Limits API calls by the global bucket and the bucket of the chat, 429 errors pause all calls."""
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, group_rate=GROUP_RATE, burst_size=BURST_SIZE):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst_size = burst_size
+
+        self.__lock = threading.Lock()
+        self.__global_bucket = TokenBucket(global_rate, global_rate)
+        self.__chat_buckets = {}
+        self.__resume_time = 0
+
+    def __get_chat_bucket(self, chat_id):
+        with self.__lock:
+            bucket = self.__chat_buckets.get(chat_id)
+            if bucket is None:
+                # Groups and channels have negative IDs
+                rate = self.group_rate if chat_id < 0 else self.chat_rate
+                bucket = self.__chat_buckets[chat_id] = TokenBucket(rate, self.burst_size)
+            return bucket
+
+    def acquire(self, chat_id):
+        self.__get_chat_bucket(chat_id).acquire()
+
+        delay = self.__resume_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        self.__global_bucket.acquire()
+
+    def pause(self, seconds):
+        with self.__lock:
+            self.__resume_time = max(self.__resume_time, time.monotonic() + seconds)
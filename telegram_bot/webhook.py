@@ -0,0 +1,95 @@
+import hmac
+import json
+import logging
+import secrets
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from telebot import apihelper, types
+
+logger = logging.getLogger('Webhook')
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WebhookServer:
+    """
+    HTTP server to get updates from Telegram by the webhook behind the reverse proxy.
+
+    Updates are passed to the bot which runs handlers on its worker pool,
+    so the server answers to Telegram right away. Only requests with the secret token
+    set for the webhook are accepted, the secret is generated on start if it isn't configured.
+    """
+
+    def __init__(self, bot, url, host='127.0.0.1', port=8080, path='/webhook', secret_token=None):
+        self.bot = bot
+        self.url = url
+        self.host = host
+        self.path = path
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+
+        self.__server = ThreadingHTTPServer((host, port), self.__get_handler_class())
+        # Port 0 means any free port
+        self.port = self.__server.server_address[1]
+
+    def __get_handler_class(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+
+                secret_token = self.headers.get(SECRET_TOKEN_HEADER, '')
+                if not hmac.compare_digest(secret_token.encode(), server.secret_token.encode()):
+                    logger.warning(f'Update with wrong secret token from {self.client_address[0]}')
+                    self.send_error(403)
+                    return
+
+                try:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    update = types.Update.de_json(json.loads(body))
+                except Exception as e:
+                    logger.error(f'Impossible to parse update:\n{e}')
+                    self.send_error(400)
+                    return
+
+                self.send_response(200)
+                self.end_headers()
+                server.bot.process_new_updates([update])
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt % args)
+
+        return WebhookHandler
+
+    def __set_webhook(self):
+        # TeleBot.set_webhook of the used pyTelegramBotAPI version has no secret_token parameter
+        apihelper._make_request(
+            self.bot.token,
+            'setWebhook',
+            method='post',
+            params={
+                'url': f'{self.url.rstrip("/")}{self.path}',
+                'secret_token': self.secret_token,
+            },
+        )
+
+    def serve(self):
+        self.bot.remove_webhook()
+        self.__set_webhook()
+        logger.info(f'Webhook server is started on {self.host}:{self.port}')
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+            # Webhook is removed, so the bot can be started in polling mode later
+            self.bot.remove_webhook()
+
+    def shutdown(self):
+        self.__server.shutdown()
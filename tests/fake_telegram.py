@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlparse
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'fake_bot'}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeTelegram:
+    """
+    Fake Bot API server which records calls of API methods.
+
+    Use `api_url` as `telegram_api_url` of the bot config or as `apihelper.API_URL`.
+    Errors for chats are set by `fail_chat(chat_id, code, description)`.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.chat_errors = {}
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), self.__get_handler_class())
+        self.api_url = f'http://127.0.0.1:{self.__server.server_address[1]}/bot{{0}}/{{1}}'
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def fail_chat(self, chat_id, code, description):
+        self.chat_errors[str(chat_id)] = (code, description)
+
+    def get_calls(self, method):
+        with self.__lock:
+            return [params for name, params in self.calls if name == method]
+
+    def wait_calls(self, method, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.get_calls(method)) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.get_calls(method)
+
+    def record(self, method, params):
+        with self.__lock:
+            self.calls.append((method, params))
+
+    def get_response(self, method, params):
+        error = self.chat_errors.get(params.get('chat_id'))
+        if error is not None:
+            return error[0], {'ok': False, 'error_code': error[0], 'description': error[1]}
+        return 200, {'ok': True, 'result': self.__get_result(method, params)}
+
+    def __get_result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'sendDocument'):
+            return {
+                'message_id': len(self.calls),
+                'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        return True
+
+    def __get_handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.handle_call(b'')
+
+            def do_POST(self):
+                self.handle_call(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            def handle_call(self, body):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qsl(body.decode()))
+
+                fake.record(method, params)
+                code, data = fake.get_response(method, params)
+
+                body = json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        return Handler
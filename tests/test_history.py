@@ -0,0 +1,30 @@
+import pytest
+
+from build_tester.history import get_percentile
+from build_tester.result_matrix import Result
+from build_tester.results_store import ResultsStore
+
+
+@pytest.mark.parametrize('values, percent, expected', [
+    ([], 50, None),
+    ([3], 90, 3),
+    ([1, 2, 3, 4], 50, 2),
+    ([1, 2, 3, 4, 5], 50, 3),
+    (list(range(1, 11)), 90, 9),
+    (list(range(1, 11)), 100, 10),
+    ([5, 1, 4, 2, 3], 0, 1),
+])
+def test_percentile_is_nearest_rank(values, percent, expected):
+    assert get_percentile(values, percent) == expected
+
+
+def test_unfinished_runs_are_not_in_history(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.db'))
+    interrupted_run_id = store.create_run()
+    store.save_build(interrupted_run_id, 'ubuntu', 'script', Result.FAIL, timings={'total': 1})
+    run_id = store.create_run()
+    store.save_build(run_id, 'ubuntu', 'script', Result.OK, timings={'total': 2})
+    store.finish_run(run_id, '20220101_000000', is_ok=True)
+
+    assert store.delete_unfinished_runs(run_id) == 1
+    assert list(map(tuple, store.get_builds_history())) == [('20220101_000000', 'ubuntu', 'script', 'OK', 2)]
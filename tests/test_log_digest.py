@@ -0,0 +1,83 @@
+from build_tester.failure_signatures import get_signature
+from build_tester.helpers.log_digest import LogDigest
+from build_tester.helpers.common import (
+    get_header_str, get_subheader_str, get_title_str, get_lines_with_title, log_accepted_error,
+)
+
+
+def write_log(path, lines):
+    with open(path, mode='w') as fs:
+        for line in lines:
+            if line is not None:
+                print(line, file=fs)
+
+
+def test_signature_is_taken_from_failed_step(tmp_path):
+    log_lines = []
+    log = log_lines.append
+    log(get_header_str('RESTORE STEP'))
+    log(get_subheader_str('COMMAND: VBoxManage controlvm ubuntu poweroff'))
+    log(get_lines_with_title('STDERR', "VBoxManage: error: Machine 'ubuntu' is not currently running"))
+    log(get_lines_with_title('EXIT CODE', 1, with_new_line=False))
+    log_accepted_error('not currently running', log=log)
+    log(get_subheader_str('COMMAND: VBoxManage snapshot ubuntu restore base'))
+    log(get_lines_with_title('STDERR', 'VBoxManage: error: Failed to lock session'))
+    log(get_lines_with_title('EXIT CODE', 1, with_new_line=False))
+    log(get_subheader_str('COMMAND: VBoxManage snapshot ubuntu restore base'))
+    log(get_lines_with_title('EXIT CODE', 0, with_new_line=False))
+    log(get_header_str('RUN STEP'))
+    log(get_subheader_str('COMMAND: sh /tmp/run.sh'))
+    log(get_title_str('LOGS'))
+    log(get_subheader_str('STEP: apt-get install -y tarantool'))
+    log('Reading package lists...')
+    log('STDERR: E: Unable to locate package tarantool')
+    log(get_lines_with_title('STEP EXIT CODE', 100, with_new_line=False))
+    log(get_lines_with_title('EXIT CODE', 100, with_new_line=False))
+    log(get_header_str('RESTORE STEP'))
+    log(get_subheader_str('COMMAND: VBoxManage controlvm ubuntu poweroff'))
+    log(get_lines_with_title('EXIT CODE', 0, with_new_line=False))
+    log_path = tmp_path / 'ubuntu.log'
+    write_log(log_path, log_lines)
+
+    assert get_signature(str(log_path)) == 'STDERR: E: Unable to locate package tarantool'
+
+
+def test_signature_is_taken_from_last_error_without_exit_codes(tmp_path):
+    log_path = tmp_path / 'ubuntu-docker.log'
+    write_log(log_path, [
+        get_header_str('BUILD STEP'),
+        'Impossible to build container: exit status 100!',
+        get_subheader_str('BUILD LOGS'),
+        'debconf: unable to initialize frontend: Dialog',
+        'E: Unable to locate package tarantool',
+        "The command '/bin/sh -c apt-get install -y tarantool' returned a non-zero code: 100",
+    ])
+
+    assert get_signature(str(log_path)) == 'E: Unable to locate package tarantool'
+
+
+
+def test_excerpt_is_taken_from_failed_step(tmp_path):
+    log_path = tmp_path / 'ubuntu.log'
+    write_log(log_path, [
+        get_header_str('RESTORE STEP'),
+        get_subheader_str('COMMAND: VBoxManage controlvm ubuntu poweroff'),
+        "VBoxManage: error: Machine 'ubuntu' is not currently running",
+        get_lines_with_title('EXIT CODE', 1, with_new_line=False),
+        get_lines_with_title('ACCEPTED ERROR', 'not currently running', with_new_line=False),
+        get_header_str('RUN STEP'),
+        get_subheader_str('STEP: make test'),
+        'test 1 passed',
+        'test 2 failed',
+        'test 3 passed',
+        get_lines_with_title('STEP EXIT CODE', 2, with_new_line=False),
+        'cleanup error',
+    ])
+
+    assert LogDigest(context_lines=1).get_excerpt(str(log_path)) == '\n'.join([
+        'STEP: make test (EXIT CODE 2):',
+        '',
+        'test 1 passed',
+        'test 2 failed',
+        'test 3 passed',
+    ])
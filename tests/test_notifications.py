@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from telegram_bot.bot import Bot
+from telegram_bot.db import DB, NotificationStatus, SubscribeType
+from tests.fake_telegram import FakeTelegram
+
+RESULTS = {'ubuntu_20.04': {'script_2.10': 'OK'}}
+
+
+@pytest.fixture
+def telegram():
+    with FakeTelegram() as telegram:
+        yield telegram
+
+
+@pytest.fixture
+def config(tmp_path, telegram):
+    config = {
+        'telegram_token': '123:token',
+        'telegram_api_url': telegram.api_url,
+        'telegram_db': {'file': str(tmp_path / 'bot.db')},
+        'archive_dir_path': str(tmp_path / 'archive'),
+    }
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(config))
+    return config, str(config_path)
+
+
+@pytest.fixture
+def db(config):
+    db = DB(config[0]['telegram_db'])
+    with db.connection():
+        yield db
+
+
+def get_notification(db, notification_id):
+    return db.Notification.get_by_id(notification_id)
+
+
+def get_message_chats(telegram):
+    return sorted(map(lambda params: int(params['chat_id']), telegram.get_calls('sendMessage')))
+
+
+def test_notification_is_retried_only_for_failed_chats(telegram, config, db):
+    for chat_id in (1, 2, 3, 4):
+        db.subscribe(chat_id, SubscribeType.ALL)
+    notification_id = db.enqueue_notification('20220101_000000', RESULTS).id
+
+    telegram.fail_chat(2, 500, 'Internal Server Error')
+    telegram.fail_chat(3, 403, 'Forbidden: bot was blocked by the user')
+    telegram.fail_chat(4, 400, 'Bad Request: chat not found')
+    bot = Bot(config[1])
+    bot.send_pending_notifications()
+
+    assert get_message_chats(telegram) == [1, 2, 3, 4]
+    notification = get_notification(db, notification_id)
+    assert notification.status == NotificationStatus.PENDING.value
+    assert db.get_notification_chat_ids(notification) == [2]
+    # Only chats which are really gone are unsubscribed
+    assert sorted(db.get_subscribers_for_all()) == [1, 2]
+
+    telegram.chat_errors.clear()
+    telegram.calls.clear()
+    notification.next_attempt_at = 0
+    notification.save()
+    bot.send_pending_notifications()
+
+    assert get_message_chats(telegram) == [2]
+    assert get_notification(db, notification_id).status == NotificationStatus.SENT.value
+
+
+def test_notification_is_postponed_when_nothing_is_delivered(telegram, config, db):
+    db.subscribe(1, SubscribeType.ALL)
+    notification_id = db.enqueue_notification('20220101_000000', RESULTS).id
+
+    telegram.fail_chat(1, 429, 'Too Many Requests: retry after 0')
+    Bot(config[1]).send_pending_notifications()
+
+    notification = get_notification(db, notification_id)
+    assert notification.status == NotificationStatus.PENDING.value
+    assert notification.attempts == 1
+    assert db.get_notification_chat_ids(notification) == [1]
+    assert db.get_subscribers_for_all() == [1]
@@ -0,0 +1,34 @@
+from build_tester.result_matrix import Result, ResultMatrix
+from build_tester.results_store import ResultsStore
+
+
+def test_lost_builds_are_found_by_base_os_names():
+    matrix = ResultMatrix.from_dict(
+        {'ubuntu-docker_20.04': {'script': 'OK'}},
+        {'ubuntu-docker_20.04': 'ubuntu-docker'},
+    )
+    assert matrix.add_lost_builds([('ubuntu', 'script'), ('ubuntu-docker', 'script')]) == [('ubuntu', 'script')]
+    assert matrix.get('ubuntu', 'script') == Result.NO_TEST
+
+
+def test_lost_builds_are_found_by_os_names_before_versions():
+    # Base OS names are unknown for remote results
+    matrix = ResultMatrix.from_dict({'debian_11': {'script': 'OK'}})
+    assert matrix.add_lost_builds([('debian', 'script'), ('fedora', 'script')]) == [('fedora', 'script')]
+
+
+def test_lost_builds_are_not_hidden_by_similar_keys_without_base_os_names():
+    matrix = ResultMatrix.from_dict({'ubuntu-docker_20.04': {'script': 'OK'}})
+    assert matrix.add_lost_builds([('ubuntu', 'script'), ('ubuntu-docker', 'script')]) == [('ubuntu', 'script')]
+
+
+def test_base_os_names_are_stored(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.db'))
+    run_id = store.create_run()
+    store.save_build(run_id, 'ubuntu-vm', 'script', Result.OK, base_os_name='ubuntu')
+    store.save_build(run_id, 'ubuntu-vm', 'script', Result.FAIL)
+    store.save_build(run_id, 'debian_11', 'script', Result.OK)
+
+    matrix = ResultMatrix.from_dict(store.get_results(run_id), store.get_base_os_names(run_id))
+    assert matrix.add_lost_builds([('ubuntu', 'script'), ('debian', 'script')]) == []
+    assert matrix.get('ubuntu-vm', 'script') == Result.FAIL
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from telebot import TeleBot, apihelper
+
+from telegram_bot.webhook import SECRET_TOKEN_HEADER, WebhookServer
+from tests.fake_telegram import FakeTelegram
+
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 42, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'User'},
+        'text': 'hello',
+    },
+}
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    with FakeTelegram() as telegram:
+        monkeypatch.setattr(apihelper, 'API_URL', telegram.api_url)
+        yield telegram
+
+
+@pytest.fixture
+def webhook(telegram):
+    bot = TeleBot('123:token', threaded=False)
+    messages = []
+    bot.message_handler(func=lambda message: True)(messages.append)
+
+    server = WebhookServer(bot, 'https://example.com/', port=0, secret_token='secret')
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    # Webhook is removed before it's set
+    telegram.wait_calls('setWebhook', 2)
+
+    yield server, messages
+
+    server.shutdown()
+    thread.join(5)
+
+
+def post_update(server, headers):
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{server.port}{server.path}',
+        data=json.dumps(UPDATE).encode(),
+        headers={'Content-Type': 'application/json', **headers},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def wait_messages(messages, count, timeout=5):
+    # Update is processed after the response to Telegram
+    deadline = time.time() + timeout
+    while len(messages) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return messages
+
+
+def test_webhook_is_set_with_secret_token(telegram, webhook):
+    assert telegram.get_calls('setWebhook')[-1] == {'url': 'https://example.com/webhook', 'secret_token': 'secret'}
+
+
+@pytest.mark.parametrize('headers', [{}, {SECRET_TOKEN_HEADER: 'wrong'}])
+def test_update_with_wrong_secret_token_is_rejected(webhook, headers):
+    server, messages = webhook
+    assert post_update(server, headers) == 403
+    time.sleep(0.1)
+    assert messages == []
+
+
+def test_update_with_secret_token_is_processed(webhook):
+    server, messages = webhook
+    assert post_update(server, {SECRET_TOKEN_HEADER: 'secret'}) == 200
+    assert [message.text for message in wait_messages(messages, 1)] == ['hello']
+